@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+import os, sys, timeit
+
+## Microbenchmark of decoding a Rypar uplink payload - the compiled schema decoder
+## against pulling each short key out of the dict by hand (as target.uplink used to)
+##
+## Run with : python benchmarks/bench_decode.py [iterations]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+
+import rypar
+
+
+PAYLOAD = {
+    "s" : "350457791234567",
+    "s1Value" : 143.5,
+    "s1Sensor" : "ultrasonic",
+    "s1Units" : "cm",
+    "unix_s" : 1700000000,
+    "la" : "-27.4705",
+    "lo" : "153.0260",
+    "rsrp" : -97,
+    "bv" : 3.52,
+    "bt" : 31,
+    "ac" : 6,
+    "ti" : 12.4,
+    "ss" : 7.4,
+    "sf" : 1.2,
+    "th" : False,
+    "sh" : 182344,
+    "sr" : "5f1c2d0e-8a7b-4c55-9f4e-1d2c3b4a5968",
+}
+
+
+def decode_by_hand(payload):
+    return (
+        payload['s'], payload['s1Value'], payload['s1Sensor'], payload['s1Units'],
+        payload['unix_s'], float(payload['la']), float(payload['lo']), payload['rsrp'],
+        payload['bv'], payload['bt'], payload['ac'], payload['ti'], payload['ss'],
+        payload['sf'], payload['th'], payload['sh'], payload['sr'],
+    )
+
+
+def main():
+
+    iterations = 200000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    missing = dict(PAYLOAD)
+    del missing['rsrp']
+    del missing['sr']
+
+    cases = [
+        ("by hand", lambda: decode_by_hand(PAYLOAD)),
+        ("decoder", lambda: rypar.decode_uplink(PAYLOAD)),
+        ("decoder (2 missing)", lambda: rypar.decode_uplink(missing)),
+    ]
+
+    print("Rypar uplink decode cost over " + str(iterations) + " messages")
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=iterations, repeat=5))
+        print("%-20s %7.2f us / message" % (name, best / iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+import os, sys, time
+
+## Throughput and queue lag of fleet.fleet_runner for a fleet of agents, each
+## with its own Rypar device, against the local fake Doover API - run in its own
+## process, so the server isn't competing with the runner's workers for the GIL
+## Each round queues one uplink for every agent in a burst, as a fleet of devices
+## on the same connection period would - the first round is cold (settings and
+## state fetched for every agent), later ones run on warm state
+##
+## Run with : python benchmarks/bench_fleet.py [agents] [rounds] [workers,...] [latency_ms]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "processor"))
+sys.path.insert(0, BENCH_DIR)
+
+import fleet
+from fake_doover_api import fake_doover_api_process
+from bench_invocations import UI_CMDS, make_uplink_payload
+
+
+def get_agent_id(a):
+    return "agent-%06d" % a
+
+
+def make_msg_obj(a, i):
+
+    payload = make_uplink_payload(i)
+    payload["s"] = "35045779%07d" % a
+    return {
+        "message" : "msg-" + str(a) + "-" + str(i),
+        "channel" : "bench",
+        "payload" : payload,
+    }
+
+
+def run_round(runner, agents, i):
+
+    runner.reset_stats()
+    for a in range(agents):
+        runner.submit(get_agent_id(a), make_msg_obj(a, i))
+    runner.join()
+    return runner.format_stats()
+
+
+def main():
+
+    agents = 10000
+    rounds = 3
+    workers = [8, 32, 64]
+    latency_ms = 5.0
+    if len(sys.argv) > 1:
+        agents = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        workers = [int(w) for w in sys.argv[3].split(",")]
+    if len(sys.argv) > 4:
+        latency_ms = float(sys.argv[4])
+
+    api = fake_doover_api_process(latency=latency_ms / 1000).start()
+    for a in range(agents):
+        api.set_aggregate(get_agent_id(a), "ui_cmds", UI_CMDS)
+
+    print("fleet_runner with " + str(agents) + " agents against the fake API with " + str(latency_ms) + " ms latency")
+    try:
+        i = 0
+        for worker_count in workers:
+            runner = fleet.fleet_runner(
+                api_endpoint=api.endpoint,
+                access_token="bench-token",
+                package_config={"log_api_timings" : False},
+                workers=worker_count,
+            ).start()
+
+            for r in range(rounds):
+                api.reset_stats()
+                t0 = time.perf_counter()
+                line = run_round(runner, agents, i)
+                calls = api.get_stats()["requests"]
+                print("%3d workers round %d : %s | %.2f calls/msg" % (worker_count, r, line, calls / agents))
+                i += 1
+
+            runner.stop()
+    finally:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import os, sys, time, json, math, random, statistics
+
+## Time to empty forecasting over a year of synthetic 5 minute tank level readings
+## The tank drains at a rate that varies over the day and drifts over the year,
+## with sensor noise, refills whenever it falls below REFILL_LEVEL and a handful
+## of multi hour / multi day coverage gaps. Reports the cost per update, the
+## state size, and how far the forecast days until REFILL_LEVEL were from when
+## the tank actually got there
+##
+## Run with : python benchmarks/bench_forecast.py [days]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+
+import rypar
+
+
+INTERVAL = 300
+REFILL_LEVEL = 15.0
+REFILL_TO = 95.0
+NOISE = 0.3
+GAPS = 6
+
+
+def make_readings(days, seed=1):
+
+    rnd = random.Random(seed)
+    count = days * 86400 // INTERVAL
+
+    gaps = set()
+    for _ in range(GAPS):
+        start = rnd.randrange(count)
+        length = rnd.randrange(6 * 3600, 3 * 86400) // INTERVAL
+        gaps.update(range(start, start + length))
+
+    readings = []
+    level = REFILL_TO
+    t0 = 1700000000
+    for i in range(count):
+        t = t0 + i * INTERVAL
+        hour = (t % 86400) / 3600
+        ## %/h - busier during the day, and slowly changing over the year
+        rate = 0.25 * (1 + 0.6 * math.sin((hour - 6) / 24 * 2 * math.pi)) * (1 + 0.3 * math.sin(i / count * 2 * math.pi))
+        level -= rate * INTERVAL / 3600
+        if level < REFILL_LEVEL:
+            level = REFILL_TO
+        if i not in gaps:
+            readings.append( (t, level + rnd.uniform(-NOISE, NOISE), level) )
+
+    return readings
+
+
+## When the (noise free) level next reaches REFILL_LEVEL, for each reading
+def get_actual_low_times(readings):
+
+    actual = [None] * len(readings)
+    next_low = None
+    for i in range(len(readings) - 1, -1, -1):
+        t, measured, level = readings[i]
+        if i + 1 < len(readings) and readings[i + 1][2] > level + rypar.DEFAULT_REFILL_THRESHOLD:
+            next_low = t
+        actual[i] = next_low
+    return actual
+
+
+def main():
+
+    days = 365
+    if len(sys.argv) > 1:
+        days = int(sys.argv[1])
+
+    readings = make_readings(days)
+    actual = get_actual_low_times(readings)
+
+    forecaster = rypar.consumption_forecaster()
+    errors = []
+
+    t0 = time.perf_counter()
+    for t, measured, level in readings:
+        forecaster.update(t, measured)
+    elapsed = time.perf_counter() - t0
+
+    forecaster = rypar.consumption_forecaster()
+    for i, (t, measured, level) in enumerate(readings):
+        forecaster.update(t, measured)
+        ## Skip the first week while the average warms up
+        if t - readings[0][0] < 7 * 86400 or actual[i] is None:
+            continue
+        predicted = forecaster.days_until(REFILL_LEVEL)
+        if predicted is not None:
+            errors.append(abs(predicted - (actual[i] - t) / 86400))
+
+    state = json.dumps(forecaster.to_state())
+
+    print("consumption_forecaster over " + str(len(readings)) + " readings (" + str(days) + " days at " + str(INTERVAL) + "s, with gaps and refills)")
+    print("update          %7.2f us per reading" % (elapsed / len(readings) * 1e6))
+    print("state           %7d B" % len(state))
+    print("days until low  median error %5.2f days   p90 %5.2f days" % (
+        statistics.median(errors),
+        sorted(errors)[int(len(errors) * 0.9)],
+    ))
+
+
+if __name__ == "__main__":
+    main()
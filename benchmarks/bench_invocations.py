@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+import os, sys, time, json, statistics, tracemalloc
+
+## End to end benchmark of target.execute for each task type, run against the
+## local fake Doover API. Reports per invocation wall time, HTTP calls, bytes sent
+## and received, and peak (python) memory
+##
+## Run with : python benchmarks/bench_invocations.py [iterations] [latency_ms]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "processor"))
+sys.path.insert(0, BENCH_DIR)
+
+import target
+from fake_doover_api import fake_doover_api
+
+
+AGENT_ID = "9843b273-6580-4520-bdb0-0afb7bfec049"
+
+UI_CMDS = {
+    "cmds" : {
+        "tankHeight" : 230,
+        "inputZeroCal" : 5,
+        "minColourState" : "red",
+        "midColourState" : "yellow",
+        "maxColourState" : "green",
+        "maxLevel" : 100,
+        "maxMidLevel" : 70,
+        "midMinLevel" : 30,
+        "minLevel" : 0,
+    }
+}
+
+
+def make_uplink_payload(i):
+    return {
+        "s" : "350457791234567",
+        "s1Value" : 100 + (i % 50),
+        "s1Sensor" : "ultrasonic",
+        "s1Units" : "cm",
+        "unix_s" : 1700000000 + i * 300,
+        "la" : "-27.4705",
+        "lo" : "153.0260",
+        "rsrp" : -97,
+        "bv" : 3.52,
+        "bt" : 31,
+        "ac" : 6,
+        "ti" : 12.4,
+        "ss" : 7.4,
+        "sf" : 1.2,
+        "th" : False,
+        "sh" : 182344,
+        "sr" : "5f1c2d0e-8a7b-4c55-9f4e-1d2c3b4a5968",
+    }
+
+
+def make_kwargs(api, log_channel, message_type, i, package_config=None):
+
+    config = {"message_type" : message_type}
+    if package_config is not None:
+        config.update(package_config)
+
+    msg_obj = {
+        "message" : "msg-" + str(i),
+        "channel" : "bench",
+        "payload" : make_uplink_payload(i) if message_type == "UPLINK" else {},
+    }
+
+    return {
+        "agent_id" : AGENT_ID,
+        "access_token" : "bench-token",
+        "api_endpoint" : api.endpoint,
+        "package_config" : config,
+        "msg_obj" : msg_obj,
+        "task_id" : "bench-task",
+        "log_channel" : log_channel,
+        "agent_settings" : {"deployment_config" : {}},
+    }
+
+
+def run_invocation(api, kwargs):
+
+    api.reset_stats()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+
+    target.target(**kwargs).execute()
+
+    wall = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = api.get_stats()
+    return {
+        "wall_ms" : wall * 1000,
+        "calls" : stats["requests"],
+        "bytes_sent" : stats["bytes_received"],
+        "bytes_received" : stats["bytes_sent"],
+        "peak_kb" : peak / 1024,
+    }
+
+
+def report(name, results):
+
+    first = results[0]
+    rest = results[1:] or results
+    print(
+        "%-22s first %8.1f ms %3d calls | warm median %8.1f ms %5.1f calls %8.0f B sent %8.0f B recv %8.0f KB peak" % (
+            name,
+            first["wall_ms"],
+            first["calls"],
+            statistics.median([r["wall_ms"] for r in rest]),
+            statistics.median([r["calls"] for r in rest]),
+            statistics.median([r["bytes_sent"] for r in rest]),
+            statistics.median([r["bytes_received"] for r in rest]),
+            statistics.median([r["peak_kb"] for r in rest]),
+        )
+    )
+
+
+def main():
+
+    iterations = 20
+    latency_ms = 20.0
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency_ms = float(sys.argv[2])
+
+    api = fake_doover_api(latency=latency_ms / 1000).start()
+    api.set_aggregate(AGENT_ID, "ui_cmds", UI_CMDS)
+    log_channel = api.get_channel(AGENT_ID, "bench_log").channel_id
+
+    cases = [
+        ("DEPLOY", "DEPLOY", None),
+        ("DOWNLINK", "DOWNLINK", None),
+        ("UPLINK", "UPLINK", None),
+        ("UPLINK (async)", "UPLINK", {"async_publish" : True}),
+    ]
+
+    print("target.execute against the fake API with " + str(latency_ms) + " ms latency, " + str(iterations) + " invocations each")
+    try:
+        for c, (name, message_type, package_config) in enumerate(cases):
+            ## Numbered on from the earlier cases - a reading repeated from one would
+            ## be skipped by the uplink dedup, and not measure the publish at all
+            results = [
+                run_invocation(api, make_kwargs(api, log_channel, message_type, c * iterations + i, package_config))
+                for i in range(iterations)
+            ]
+            report(name, results)
+    finally:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
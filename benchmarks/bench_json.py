@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import os, sys, timeit
+
+## Serialization cost of the real documents target publishes - the deploy UI
+## definition and an uplink ui_state patch - for each available pydoover JSON backend
+##
+## Run with : python benchmarks/bench_json.py [iterations]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "processor"))
+sys.path.insert(0, BENCH_DIR)
+
+import pydoover
+import target
+from bench_invocations import UI_CMDS, make_uplink_payload
+
+
+def get_documents():
+
+    t = target.target(agent_id="bench", package_config={})
+    ui_obj = t.build_ui_obj()
+
+    settings = t.get_uplink_settings(UI_CMDS)
+    msg_obj = {"message" : "bench", "channel" : "bench", "payload" : make_uplink_payload(1)}
+    position, ui_state = t.process_uplink(msg_obj, settings)
+
+    return [
+        ("deploy ui_obj", ui_obj),
+        ("uplink ui_state", ui_state),
+    ]
+
+
+def main():
+
+    iterations = 2000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    backends = ["json"]
+    if pydoover.orjson is not None:
+        backends.append("orjson")
+
+    print("JSON backends over " + str(iterations) + " iterations")
+    for doc_name, doc in get_documents():
+        for backend_name in backends:
+            backend = pydoover.JSON_BACKENDS[backend_name]()
+            encoded = backend.dumps(doc)
+            raw = encoded.encode()
+
+            dumps = min(timeit.repeat(lambda: backend.dumps(doc), number=iterations, repeat=5)) / iterations
+            loads = min(timeit.repeat(lambda: backend.loads(raw), number=iterations, repeat=5)) / iterations
+            print("%-16s %-7s %6d B   dumps %7.2f us   loads %7.2f us" % (
+                doc_name, backend_name, len(raw), dumps * 1e6, loads * 1e6,
+            ))
+
+
+if __name__ == "__main__":
+    main()
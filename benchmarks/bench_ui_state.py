@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+import os, sys, timeit
+
+## Cost of producing the uplink ui_state patch - building the nested dict from the
+## UPLINK_UI_STATE template, and serializing it with the backend alone vs the
+## template's pre-serialized skeleton - for each available pydoover JSON backend
+##
+## Run with : python benchmarks/bench_ui_state.py [iterations]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "processor"))
+sys.path.insert(0, BENCH_DIR)
+
+import pydoover
+import rypar
+import target
+from bench_invocations import UI_CMDS, make_uplink_payload
+
+
+def get_values(t, settings):
+
+    uplink, problems = rypar.decode_uplink(make_uplink_payload(1))
+    values = uplink.to_dict()
+    values['last_reading'] = "2023-11-15 08:13 AM"
+    values['perc_reading'] = ((uplink.reading - settings['inputZeroCal']) / settings['tankHeight']) * 100
+    values['level_ranges'] = t.get_level_ranges(settings)
+    values.update(t.update_level_stats(uplink, settings))
+    values.update(t.update_forecast(uplink, settings))
+    values['position'] = {'lat' : uplink.lat, 'long' : uplink.long}
+
+    missing = [name for name in target.UPLINK_UI_STATE.names if name not in values]
+    if len(missing) > 0:
+        raise Exception("No bench values for " + ", ".join(missing))
+    return values
+
+
+def main():
+
+    iterations = 20000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    t = target.target(agent_id="bench", package_config={})
+    settings = t.get_uplink_settings(UI_CMDS)
+    values = get_values(t, settings)
+    template = target.UPLINK_UI_STATE
+    patch = template.build(values)
+
+    def timed(fn):
+        return min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations * 1e6
+
+    backends = ["json"]
+    if pydoover.orjson is not None:
+        backends.append("orjson")
+
+    print("uplink ui_state over " + str(iterations) + " iterations")
+    print("%-24s %7.2f us" % ("build", timed(lambda: template.build(values))))
+    print("%-24s %7.2f us" % ("extract", timed(lambda: template.extract(patch))))
+    for backend_name in backends:
+        pydoover.set_json_backend(backend_name)
+        print("%-24s %7.2f us" % ("json_dumps (" + backend_name + ")", timed(lambda: pydoover.json_dumps(patch))))
+        print("%-24s %7.2f us" % ("dumps (" + backend_name + ")", timed(lambda: template.dumps(values))))
+        print("%-24s %7.2f us" % ("dumps_patch (" + backend_name + ")", timed(lambda: template.dumps_patch(patch))))
+    pydoover.set_json_backend()
+
+
+if __name__ == "__main__":
+    main()
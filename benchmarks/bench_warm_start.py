@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+import os, sys, time, statistics
+
+## Compares the startup cost of a cold invocation (pydoover re-imported and a new
+## client built, as target.py used to do) against a warm one (module and client reused)
+##
+## Run with : python benchmarks/bench_warm_start.py [iterations]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+
+import pydoover
+
+
+AGENT_ID = "9843b273-6580-4520-bdb0-0afb7bfec049"
+ENDPOINT = "https://my.doover.dev"
+
+
+def cold_start(access_token):
+
+    t0 = time.perf_counter()
+    del sys.modules['pydoover']
+    import pydoover as pd
+    t1 = time.perf_counter()
+    pd.doover_iface(
+        agent_id=AGENT_ID,
+        access_token=access_token,
+        endpoint=ENDPOINT,
+    )
+    t2 = time.perf_counter()
+
+    return t1 - t0, t2 - t1
+
+
+def warm_start(access_token):
+
+    t0 = time.perf_counter()
+    import pydoover as pd
+    t1 = time.perf_counter()
+    pd.get_doover_client(
+        agent_id=AGENT_ID,
+        access_token=access_token,
+        endpoint=ENDPOINT,
+    )
+    t2 = time.perf_counter()
+
+    return t1 - t0, t2 - t1
+
+
+def report(name, results):
+
+    imports = [r[0] * 1e6 for r in results]
+    builds = [r[1] * 1e6 for r in results]
+    print(
+        "%-5s import median %9.1f us   client median %9.1f us   total median %9.1f us" % (
+            name,
+            statistics.median(imports),
+            statistics.median(builds),
+            statistics.median([i + b for i, b in zip(imports, builds)]),
+        )
+    )
+
+
+def main():
+
+    iterations = 200
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    cold = [cold_start("token-" + str(i)) for i in range(iterations)]
+
+    ## Prime the registry as the first invocation in a container would
+    import pydoover as pd
+    pd.get_doover_client(agent_id=AGENT_ID, access_token="token", endpoint=ENDPOINT)
+    warm = [warm_start("token-" + str(i)) for i in range(iterations)]
+
+    print("pydoover startup over " + str(iterations) + " invocations")
+    report("cold", cold)
+    report("warm", warm)
+
+
+if __name__ == "__main__":
+    main()
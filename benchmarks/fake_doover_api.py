@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+import json, time, uuid, threading, multiprocessing
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+## A local, in-process stand-in for the parts of the Doover channels API used by
+## pydoover.doover_api_iface, so processors can be run and measured without
+## hitting my.doover.dev
+##
+##   api = fake_doover_api(latency=0.02)
+##   api.start()
+##   cli = pydoover.doover_iface(agent_id=..., access_token="x", endpoint=api.endpoint)
+##   ...
+##   api.stop()
+##
+## Channels are created on first use. Published JSON objects are deep merged into
+## the channel aggregate, anything else replaces it
+## Publishes carrying an Idempotency-Key header are only applied once per key, and
+## fail_next() makes the next requests fail, to exercise retries
+## The batch publish endpoint (POST /ch/v1/publish/) can be turned off with
+## batch_publish=False, to exercise the fallback to one POST per message
+##
+## fake_doover_api_process runs it in a separate process instead, so a busy server
+## doesn't compete for the GIL with the client being measured
+
+
+def merge_aggregate(target, patch):
+
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_aggregate(target[key], value)
+        else:
+            target[key] = value
+
+    return target
+
+
+class fake_channel:
+
+    def __init__(self, agent_id, name):
+
+        self.channel_id = str(uuid.uuid4())
+        self.agent_id = agent_id
+        self.name = name
+        self.aggregate = {}
+        self.messages = []
+
+    def get_details(self):
+        return {
+            "channel" : self.channel_id,
+            "owner" : self.agent_id,
+            "name" : self.name,
+            "aggregate" : {
+                "payload" : self.aggregate,
+            },
+        }
+
+    def publish(self, body):
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = body
+
+        if isinstance(payload, dict) and isinstance(self.aggregate, dict):
+            merge_aggregate(self.aggregate, payload)
+        else:
+            self.aggregate = payload
+
+        message = {
+            "message" : str(uuid.uuid4()),
+            "agent" : self.agent_id,
+            "channel" : self.channel_id,
+            "timestamp" : time.time(),
+            "payload" : payload,
+        }
+        self.messages.append(message)
+
+        return message
+
+
+class fake_doover_api:
+
+    ## listing_payloads includes each message's payload in the message listing, as
+    ## some API versions do - otherwise it has to be fetched message by message
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, batch_publish=True, listing_payloads=False):
+
+        self.latency = latency
+        self.batch_publish = batch_publish
+        self.listing_payloads = listing_payloads
+        self.channels = {}
+        self.channels_by_name = {}
+        self.lock = threading.RLock()
+        self.idempotency_keys = {}
+        self.failures = []
+        self.reset_stats()
+
+        api = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                api.handle(self, "GET")
+
+            def do_POST(self):
+                api.handle(self, "POST")
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+
+        with self.lock:
+            self.stats = {
+                "requests" : 0,
+                "GET" : 0,
+                "POST" : 0,
+                "bytes_received" : 0,
+                "bytes_sent" : 0,
+            }
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+    ## The next `count` requests get `status` instead of being handled
+    def fail_next(self, count=1, status=503):
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def get_channel(self, agent_id, name):
+
+        with self.lock:
+            key = (agent_id, name)
+            if key not in self.channels_by_name:
+                c = fake_channel(agent_id, name)
+                self.channels[c.channel_id] = c
+                self.channels_by_name[key] = c
+            return self.channels_by_name[key]
+
+    def set_aggregate(self, agent_id, name, aggregate):
+
+        c = self.get_channel(agent_id, name)
+        with self.lock:
+            c.aggregate = aggregate
+        return c
+
+    def add_messages(self, agent_id, name, payloads):
+
+        c = self.get_channel(agent_id, name)
+        with self.lock:
+            for payload in payloads:
+                c.publish(json.dumps(payload))
+        return c
+
+
+    def resolve(self, parts):
+
+        ## /ch/v1/channel/<id>/...  or  /ch/v1/agent/<agent>/<name>/...
+        if len(parts) >= 4 and parts[2] == "channel":
+            c = self.channels.get(parts[3])
+            return c, parts[4:]
+        if len(parts) >= 5 and parts[2] == "agent":
+            return self.get_channel(parts[3], parts[4]), parts[5:]
+        return None, parts
+
+    def route(self, method, path, query, body, idempotency_key=None):
+
+        parts = [p for p in path.split("/") if p]
+        if parts[:2] != ["ch", "v1"]:
+            return 404, {"error" : "not found"}
+
+        if method == "POST" and parts == ["ch", "v1", "publish"] and self.batch_publish:
+            return self.publish_batch(body, idempotency_key)
+
+        ## Agent details
+        if method == "GET" and len(parts) == 4 and parts[2] == "agent":
+            agent_id = parts[3]
+            with self.lock:
+                channels = [c for c in self.channels.values() if c.agent_id == agent_id]
+                return 200, {
+                    "agent" : agent_id,
+                    "channels" : [{"channel" : c.channel_id, "agent" : c.agent_id, "name" : c.name} for c in channels],
+                }
+
+        c, rest = self.resolve(parts)
+        if c is None:
+            return 404, {"error" : "channel not found"}
+
+        with self.lock:
+
+            if method == "GET" and len(rest) == 0:
+                return 200, c.get_details()
+
+            if method == "GET" and rest == ["messages"]:
+                return 200, {"messages" : self.get_messages_page(c, query)}
+
+            if method == "GET" and len(rest) == 2 and rest[0] == "message":
+                for m in c.messages:
+                    if m["message"] == rest[1]:
+                        return 200, m
+                return 404, {"error" : "message not found"}
+
+            if method == "POST" and len(rest) == 0:
+                if idempotency_key is not None and idempotency_key in self.idempotency_keys:
+                    return 200, self.idempotency_keys[idempotency_key]
+                message_id = c.publish(body)["message"]
+                if idempotency_key is not None:
+                    self.idempotency_keys[idempotency_key] = message_id
+                return 200, message_id
+
+        return 404, {"error" : "not found"}
+
+    def publish_batch(self, body, idempotency_key=None):
+
+        with self.lock:
+            if idempotency_key is not None and idempotency_key in self.idempotency_keys:
+                return 200, self.idempotency_keys[idempotency_key]
+
+            results = []
+            for message in json.loads(body)["messages"]:
+                if "channel" in message:
+                    c = self.channels.get(message["channel"])
+                else:
+                    c = self.get_channel(message["agent"], message["channel_name"])
+                if c is None:
+                    return 404, {"error" : "channel not found"}
+
+                key = message.get("idempotency_key")
+                if key is not None and key in self.idempotency_keys:
+                    results.append(self.idempotency_keys[key])
+                    continue
+                message_id = c.publish(message["payload"])["message"]
+                if key is not None:
+                    self.idempotency_keys[key] = message_id
+                results.append(message_id)
+
+            result = {"results" : results}
+            if idempotency_key is not None:
+                self.idempotency_keys[idempotency_key] = result
+            return 200, result
+
+    def get_messages_page(self, c, query):
+
+        ## Newest first, paged with limit / before (message id)
+        messages = list(reversed(c.messages))
+
+        if "since" in query:
+            messages = [m for m in messages if m["timestamp"] >= float(query["since"][0])]
+        if "until" in query:
+            messages = [m for m in messages if m["timestamp"] <= float(query["until"][0])]
+        if "before" in query:
+            ids = [m["message"] for m in messages]
+            if query["before"][0] in ids:
+                messages = messages[ids.index(query["before"][0]) + 1:]
+        if "limit" in query:
+            messages = messages[:int(query["limit"][0])]
+
+        if self.listing_payloads:
+            return [dict(m) for m in messages]
+        return [
+            {"message" : m["message"], "agent" : m["agent"], "channel" : m["channel"], "timestamp" : m["timestamp"]}
+            for m in messages
+        ]
+
+    def handle(self, request, method):
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        url = urlsplit(request.path)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length).decode() if length > 0 else ""
+
+        with self.lock:
+            failure = self.failures.pop(0) if len(self.failures) > 0 else None
+
+        if failure is not None:
+            status, result = failure, {"error" : "injected failure"}
+        else:
+            status, result = self.route(method, url.path, parse_qs(url.query), body, request.headers.get("Idempotency-Key"))
+        if isinstance(result, str):
+            response = result.encode()
+        else:
+            response = json.dumps(result).encode()
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats[method] += 1
+            self.stats["bytes_received"] += length
+            self.stats["bytes_sent"] += len(response)
+
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(response)))
+        request.end_headers()
+        request.wfile.write(response)
+
+
+def serve_fake_doover_api(conn, kwargs):
+
+    api = fake_doover_api(**kwargs).start()
+    conn.send(api.endpoint)
+    while True:
+        name, args, call_kwargs = conn.recv()
+        try:
+            result = getattr(api, name)(*args, **call_kwargs)
+        except Exception as e:
+            conn.send( (e, None) )
+            continue
+        if name == "stop":
+            conn.send( (None, None) )
+            return
+        ## Channels stay on the server side
+        if isinstance(result, (fake_channel, fake_doover_api)):
+            result = None
+        conn.send( (None, result) )
+
+
+## fake_doover_api in a child process, driven over a pipe - same set up and stats
+## methods, but those that return a channel return None
+class fake_doover_api_process:
+
+    def __init__(self, **kwargs):
+
+        self.kwargs = kwargs
+        self.endpoint = None
+        self._conn = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def start(self):
+
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=serve_fake_doover_api, args=(child_conn, self.kwargs), daemon=True)
+        self._process.start()
+        self.endpoint = self._conn.recv()
+        return self
+
+    def call(self, name, *args, **kwargs):
+
+        with self._lock:
+            self._conn.send( (name, args, kwargs) )
+            error, result = self._conn.recv()
+        if error is not None:
+            raise error
+        return result
+
+    def stop(self):
+        self.call("stop")
+        self._process.join()
+
+    def reset_stats(self):
+        self.call("reset_stats")
+
+    def get_stats(self):
+        return self.call("get_stats")
+
+    def fail_next(self, count=1, status=503):
+        self.call("fail_next", count, status=status)
+
+    def set_aggregate(self, agent_id, name, aggregate):
+        self.call("set_aggregate", agent_id, name, aggregate)
+
+    def add_messages(self, agent_id, name, payloads):
+        self.call("add_messages", agent_id, name, payloads)
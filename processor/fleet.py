@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+import time, threading, collections
+
+import pydoover as pd
+import target
+
+
+## Fleet mode - runs the processor for the uplinks of many agents in one long lived
+## process, instead of one invocation per uplink
+##
+##   runner = fleet_runner(api_endpoint="https://my.doover.dev", access_token=..., workers=32)
+##   runner.start()
+##   runner.submit(agent_id, msg_obj)
+##   ...
+##   runner.stop()
+##
+## Messages are queued per agent, and an agent is only ever being processed by one
+## worker at a time - so each agent sees its uplinks in order, while different
+## agents are processed concurrently by a bounded pool of workers. When an agent
+## has a backlog, up to max_batch of its uplinks are processed as one batch
+## invocation (see target.get_uplink_msg_objs)
+## Everything target keeps warm between invocations (clients and their pooled
+## connections, cached ui_cmds settings, published state, dedup / statistics /
+## forecast state) stays warm for every agent for the life of the runner
+## With a debounce_window in package_config, held back readings are flushed by
+## the runner once their window has passed, rather than waiting on the next uplink
+## (instead of by flush requests to the on_flush task)
+
+DEFAULT_FLEET_WORKERS = 16
+DEFAULT_FLEET_MAX_BATCH = 50
+
+## Queue lag samples kept for the percentiles in get_stats
+DEFAULT_LAG_SAMPLES = 10000
+
+
+class fleet_job:
+
+    __slots__ = ("message_type", "msg_obj", "access_token", "enqueued_at")
+
+    def __init__(self, message_type, msg_obj, access_token, enqueued_at):
+        self.message_type = message_type
+        self.msg_obj = msg_obj
+        self.access_token = access_token
+        self.enqueued_at = enqueued_at
+
+
+class fleet_runner:
+
+    def __init__(
+            self,
+            api_endpoint="https://my.doover.dev",
+            access_token=None,
+            package_config=None,
+            workers=DEFAULT_FLEET_WORKERS,
+            max_batch=DEFAULT_FLEET_MAX_BATCH,
+            task_id="fleet",
+            log_channel=None,
+            lag_samples=DEFAULT_LAG_SAMPLES,
+        ):
+
+        self.api_endpoint = api_endpoint
+        self.access_token = access_token
+        self.package_config = dict(package_config or {})
+        self.package_config.setdefault('pool_size', workers)
+        ## Held readings are flushed by run_flusher, not by on_flush requests
+        self.package_config.setdefault('debounce_flush_channel', None)
+        self.workers = workers
+        self.max_batch = max_batch
+        self.task_id = task_id
+        self.log_channel = log_channel
+
+        ## Jobs per agent, and the agents with jobs that aren't being processed
+        self._queues = {}
+        self._ready = collections.deque()
+        self._active = set()
+        self._flush_queued = set()
+        self._tokens = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+        self._lags = collections.deque(maxlen=lag_samples)
+        self.reset_stats()
+
+    def reset_stats(self):
+
+        with self._cond:
+            self.started_at = time.time()
+            self.stats = {
+                "submitted" : 0,
+                "processed" : 0,
+                "invocations" : 0,
+                "errors" : 0,
+                "busy_time" : 0.0,
+                "max_lag" : 0.0,
+            }
+            self._lags.clear()
+
+    def start(self):
+
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run_worker, name="fleet-worker-" + str(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        if self.get_debounce_window() > 0:
+            thread = threading.Thread(target=self.run_flusher, name="fleet-flusher", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    ## Waits for everything queued to be processed, then stops the workers
+    def stop(self):
+
+        self.join()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    ## Waits until there is nothing queued or being processed
+    def join(self):
+        with self._cond:
+            while len(self._active) > 0:
+                self._cond.wait()
+
+    def submit(self, agent_id, msg_obj, access_token=None, message_type="UPLINK"):
+
+        with self._cond:
+            if access_token is not None:
+                self._tokens[agent_id] = access_token
+            self._queues.setdefault(agent_id, collections.deque()).append(
+                fleet_job(message_type, msg_obj, access_token, time.time())
+            )
+            if message_type == "UPLINK":
+                self.stats["submitted"] += 1
+            if agent_id not in self._active:
+                self._active.add(agent_id)
+                self._ready.append(agent_id)
+                self._cond.notify()
+
+    def get_queue_depth(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+
+    def run_worker(self):
+
+        while True:
+            with self._cond:
+                while len(self._ready) == 0 and not self._stopping:
+                    self._cond.wait()
+                if len(self._ready) == 0:
+                    return
+                agent_id = self._ready.popleft()
+                jobs = self.take_jobs(self._queues[agent_id])
+
+            started_at = time.time()
+            failed = self.run_jobs(agent_id, jobs)
+            finished_at = time.time()
+
+            with self._cond:
+                uplinks = [job for job in jobs if job.message_type == "UPLINK"]
+                for job in uplinks:
+                    lag = started_at - job.enqueued_at
+                    self._lags.append(lag)
+                    if lag > self.stats["max_lag"]:
+                        self.stats["max_lag"] = lag
+                self.stats["processed"] += len(uplinks)
+                self.stats["invocations"] += 1
+                self.stats["busy_time"] += finished_at - started_at
+                if failed:
+                    self.stats["errors"] += 1
+                if jobs[0].message_type == "FLUSH":
+                    self._flush_queued.discard(agent_id)
+
+                if len(self._queues[agent_id]) > 0:
+                    self._ready.append(agent_id)
+                else:
+                    del self._queues[agent_id]
+                    self._active.discard(agent_id)
+                self._cond.notify_all()
+
+    ## The next run of up to max_batch uplinks for an agent, or its next other job
+    def take_jobs(self, queue):
+
+        jobs = [queue.popleft()]
+        if jobs[0].message_type != "UPLINK":
+            return jobs
+        while len(queue) > 0 and len(jobs) < self.max_batch and queue[0].message_type == "UPLINK":
+            jobs.append(queue.popleft())
+        return jobs
+
+    ## Runs a single invocation of target for the jobs - returns whether it logged an error
+    def run_jobs(self, agent_id, jobs):
+
+        access_token = self._tokens.get(agent_id, self.access_token)
+        package_config = dict(self.package_config)
+        package_config['message_type'] = jobs[0].message_type
+
+        kwargs = {
+            'agent_id' : agent_id,
+            'access_token' : access_token,
+            'api_endpoint' : self.api_endpoint,
+            'package_config' : package_config,
+            'msg_obj' : jobs[-1].msg_obj,
+            'task_id' : self.task_id,
+            'log_channel' : self.log_channel,
+            'agent_settings' : {'deployment_config' : {}},
+        }
+        if len(jobs) > 1:
+            kwargs['msg_objs'] = [job.msg_obj for job in jobs]
+
+        processor = target.target(**kwargs)
+        try:
+            processor.execute()
+        except Exception:
+            return True
+
+        log = getattr(processor, '_log', None)
+        if log is None:
+            return False
+        return any(level == "ERROR" for ts, level, msg in log.get_records())
+
+
+    def get_debounce_window(self):
+        return self.package_config.get('debounce_window', 0)
+
+    ## Queue a FLUSH job for every agent with a debounced reading that's due
+    def run_flusher(self):
+
+        window = self.get_debounce_window()
+        interval = min(1.0, window / 2)
+        debouncer = pd.get_publish_debouncer()
+
+        while not self._stopping:
+            time.sleep(interval)
+            for agent_id, channel_name in debouncer.due_keys(window):
+                if channel_name != "ui_state":
+                    continue
+                with self._cond:
+                    if agent_id in self._flush_queued:
+                        continue
+                    self._flush_queued.add(agent_id)
+                self.submit(agent_id, None, message_type="FLUSH")
+
+
+    ## Throughput and queue lag since start (or reset_stats)
+    def get_stats(self):
+
+        with self._cond:
+            stats = dict(self.stats)
+            lags = sorted(self._lags)
+            stats["queue_depth"] = sum(len(q) for q in self._queues.values())
+            stats["active_agents"] = len(self._active)
+
+        elapsed = time.time() - self.started_at
+        stats["elapsed"] = elapsed
+        stats["msgs_per_sec"] = stats["processed"] / elapsed if elapsed > 0 else 0.0
+        stats["worker_utilisation"] = stats["busy_time"] / (elapsed * self.workers) if elapsed > 0 else 0.0
+        stats["mean_lag"] = sum(lags) / len(lags) if len(lags) > 0 else 0.0
+        stats["p95_lag"] = lags[int(len(lags) * 0.95)] if len(lags) > 0 else 0.0
+
+        return stats
+
+    def format_stats(self):
+
+        stats = self.get_stats()
+        return (
+            "%d msgs in %d invocations over %.1fs (%.1f msgs/s, %d errors) | queue depth %d, lag mean %.1f ms p95 %.1f ms max %.1f ms | workers %d, %.0f%% busy" % (
+                stats["processed"],
+                stats["invocations"],
+                stats["elapsed"],
+                stats["msgs_per_sec"],
+                stats["errors"],
+                stats["queue_depth"],
+                stats["mean_lag"] * 1000,
+                stats["p95_lag"] * 1000,
+                stats["max_lag"] * 1000,
+                self.workers,
+                stats["worker_utilisation"] * 100,
+            )
+        )
@@ -1,6 +1,1047 @@
 #!/usr/bin/python3
 
-import os, json, requests, time, base64, shutil
+import os, json, requests, time, base64, shutil, threading, asyncio, functools, collections, random, hashlib, sqlite3, uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from requests.adapters import HTTPAdapter
+
+
+## JSON (de)serialization
+## orjson is used when it is installed, falling back to the standard library
+## Override with the PYDOOVER_JSON_BACKEND environment variable or set_json_backend()
+
+class stdlib_json_backend:
+
+    name = "json"
+    ## Whether ui_state_template fills pre-serialized skeletons rather than
+    ## encoding whole patches - only worth it where the encoder is slow
+    use_skeletons = True
+
+    def dumps(self, obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class orjson_backend:
+
+    name = "orjson"
+    use_skeletons = False
+
+    def dumps(self, obj, sort_keys=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option).decode()
+
+    ## Parses straight from the response bytes, without decoding to str first
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+JSON_BACKENDS = {
+    "json" : stdlib_json_backend,
+    "orjson" : orjson_backend,
+}
+
+
+def set_json_backend(name=None):
+    global _json_backend
+
+    if name is None:
+        name = os.environ.get("PYDOOVER_JSON_BACKEND")
+    if name is None:
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson" and orjson is None:
+        raise Exception("orjson JSON backend requested but orjson is not installed")
+    if name not in JSON_BACKENDS:
+        raise Exception("Unknown JSON backend : " + str(name))
+
+    _json_backend = JSON_BACKENDS[name]()
+    return _json_backend
+
+
+def get_json_backend():
+    return _json_backend
+
+
+def json_dumps(obj, sort_keys=False):
+    return _json_backend.dumps(obj, sort_keys=sort_keys)
+
+
+def json_loads(data):
+    return _json_backend.loads(data)
+
+
+_json_backend = None
+set_json_backend()
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 15
+
+## Fetch modes for get_channel_details
+FETCH_ALL = "all"
+FETCH_AGGREGATE = "aggregate"
+FETCH_MESSAGES = "messages"
+
+DEFAULT_PAGE_SIZE = 500
+
+
+## Sessions are kept at module level so that warm invocations of the same
+## container reuse the already open (keep-alive) connections to the API
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def get_shared_session(pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+
+    key = (pool_size, keep_alive)
+    with _shared_sessions_lock:
+        session = _shared_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            if keep_alive:
+                session.headers["Connection"] = "keep-alive"
+            else:
+                session.headers["Connection"] = "close"
+            _shared_sessions[key] = session
+
+    return session
+
+
+def close_shared_sessions():
+
+    with _shared_sessions_lock:
+        for session in _shared_sessions.values():
+            session.close()
+        _shared_sessions.clear()
+
+
+DEFAULT_AGGREGATE_TTL = 300
+
+
+## A process level cache of channel aggregates, keyed by (agent_id, channel)
+## Warm invocations can use this to skip re-fetching aggregates that rarely change
+class aggregate_cache:
+
+    def __init__(self, ttl=DEFAULT_AGGREGATE_TTL):
+
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, agent_id, channel_name):
+
+        key = (agent_id, channel_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiry, payload = entry
+            if time.time() >= expiry:
+                del self._entries[key]
+                return None
+            return payload
+
+    def set(self, agent_id, channel_name, payload, ttl=None):
+
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[(agent_id, channel_name)] = (time.time() + ttl, payload)
+
+    def invalidate(self, agent_id, channel_name=None):
+
+        with self._lock:
+            if channel_name is not None:
+                self._entries.pop((agent_id, channel_name), None)
+                return
+            for key in [k for k in self._entries if k[0] == agent_id]:
+                del self._entries[key]
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+
+_aggregate_cache = aggregate_cache()
+
+
+def get_aggregate_cache():
+    return _aggregate_cache
+
+
+## Short, as the tracked state goes stale without this process seeing it whenever
+## another container publishes for the agent, or a deployment resets the channel
+DEFAULT_STATE_MAX_AGE = 300
+
+
+## Minimal nested diff of a state patch against what was previously published
+## Dicts are recursed into, anything else (including lists) is compared as a leaf
+def diff_state(previous, current):
+
+    delta = {}
+    for key, value in current.items():
+        if key not in previous:
+            delta[key] = value
+        elif isinstance(value, dict) and isinstance(previous[key], dict):
+            sub_delta = diff_state(previous[key], value)
+            if len(sub_delta) > 0:
+                delta[key] = sub_delta
+        elif previous[key] != value:
+            delta[key] = value
+
+    return delta
+
+
+def merge_state(target, patch):
+
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_state(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = merge_state({}, value)
+        else:
+            target[key] = value
+
+    return target
+
+
+## Remembers the state patches this process has published, per (agent_id, channel),
+## so that later publishes can send only the leaves that changed
+## Anything older than max_age is forgotten, so a full patch is re-sent at least that
+## often - this covers changes published by other containers or processors
+class state_tracker:
+
+    def __init__(self, max_age=DEFAULT_STATE_MAX_AGE):
+
+        self.max_age = max_age
+        self._states = {}
+        self._lock = threading.Lock()
+
+    ## Returns the part of patch that differs from what was last published, or
+    ## None if there is nothing to publish
+    def get_delta(self, agent_id, channel_name, patch):
+
+        key = (agent_id, channel_name)
+        with self._lock:
+            entry = self._states.get(key)
+            if entry is None or time.time() - entry[0] >= self.max_age:
+                return patch
+            delta = diff_state(entry[1], patch)
+
+        if len(delta) == 0:
+            return None
+        return delta
+
+    def mark_published(self, agent_id, channel_name, patch):
+
+        key = (agent_id, channel_name)
+        with self._lock:
+            entry = self._states.get(key)
+            if entry is None or time.time() - entry[0] >= self.max_age:
+                self._states[key] = (time.time(), merge_state({}, patch))
+            else:
+                merge_state(entry[1], patch)
+
+    def forget(self, agent_id, channel_name=None):
+
+        with self._lock:
+            if channel_name is not None:
+                self._states.pop((agent_id, channel_name), None)
+                return
+            for key in [k for k in self._states if k[0] == agent_id]:
+                del self._states[key]
+
+
+_state_tracker = state_tracker()
+
+
+def get_state_tracker():
+    return _state_tracker
+
+
+## Coalesces bursts of publishes per key (e.g. (agent_id, "ui_state")) into at most
+## one per window - within the window the newest item replaces any pending one,
+## and goes out with the next publish after the window has passed (or take_due)
+## A change of flush_token (e.g. an alarm band) is always published straight away
+class publish_debouncer:
+
+    def __init__(self):
+
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def should_publish(self, key, window, flush_token=None, now=None):
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if window <= 0 or entry is None:
+                return True
+            if flush_token != entry['flush_token']:
+                return True
+            return now - entry['published_at'] >= window
+
+    def mark_published(self, key, flush_token=None, now=None):
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            self._entries[key] = {
+                'published_at' : now,
+                'flush_token' : flush_token,
+                'pending' : None,
+            }
+
+    ## Replaces anything already pending for key
+    def hold(self, key, item):
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {'published_at' : 0, 'flush_token' : None, 'pending' : None})
+            entry['pending'] = item
+
+    def take_pending(self, key):
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            item, entry['pending'] = entry['pending'], None
+            return item
+
+    ## The keys with a pending item whose window has passed
+    def due_keys(self, window, now=None):
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            return [
+                key for key, entry in self._entries.items()
+                if entry['pending'] is not None and now - entry['published_at'] >= window
+            ]
+
+    ## Removes and returns [(key, item)] for every pending item whose window has passed
+    def take_due(self, window, now=None):
+
+        if now is None:
+            now = time.time()
+
+        due = []
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry['pending'] is not None and now - entry['published_at'] >= window:
+                    due.append( (key, entry['pending']) )
+                    entry['pending'] = None
+
+        return due
+
+    ## The (published_at, flush_token, pending) held for key, or None - so it can
+    ## be persisted for a later process to carry on from with set_entry
+    def get_entry(self, key):
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return (entry['published_at'], entry['flush_token'], entry['pending'])
+
+    def set_entry(self, key, published_at, flush_token=None, pending=None):
+
+        with self._lock:
+            self._entries[key] = {
+                'published_at' : published_at,
+                'flush_token' : flush_token,
+                'pending' : pending,
+            }
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_publish_debouncer = publish_debouncer()
+
+
+def get_publish_debouncer():
+    return _publish_debouncer
+
+
+## Builds ui_state patches from a table mapping values onto ui elements
+##
+##   fields : [(ui path, element attribute, value name, omit if None)]
+##   static : [(ui path, element attribute, value)]
+##
+## ui paths are dotted element names, each nested under 'children' of its parent,
+## e.g. ("settings_submodule.debug_submodule.deviceTemp", "currentValue", "device_temp", False)
+## fills state.children.settings_submodule.children.debug_submodule.children.deviceTemp.currentValue
+## The table is compiled once into a function that builds the whole patch as a
+## single dict display, and the static skeleton is pre-serialized per JSON backend,
+## so dumps() only has to encode the values (for backends with use_skeletons set)
+class ui_state_template:
+
+    def __init__(self, fields, static=None):
+
+        self.fields = tuple(fields)
+        self.static = tuple(static or ())
+        self.names = tuple(f[2] for f in self.fields)
+        if len(set(self.names)) != len(self.names):
+            raise Exception("ui_state_template value names must be unique")
+
+        self._skeletons = {}
+        self.build, self.extract = self.compile()
+
+    ## Generates build(values) -> patch and extract(patch) -> values
+    def compile(self):
+
+        namespace = {"set_path" : ui_state_template.set_path}
+
+        ## Element tree - each node is [attributes {attr : source}, children {name : node}]
+        root = [{}, {}]
+        optional = []
+        for path, attribute, name, omit_if_none in self.fields:
+            if omit_if_none:
+                optional.append( (path, attribute, name) )
+                continue
+            self.get_node(root, path)[0][attribute] = "values[" + repr(name) + "]"
+        for path, attribute, value in self.static:
+            self.get_node(root, path)[0][attribute] = repr(value)
+
+        lines = [
+            "def build(values):",
+            "    patch = {'state' : " + self.render_node(root) + "}",
+        ]
+        for path, attribute, name in optional:
+            lines.append("    if values[" + repr(name) + "] is not None:")
+            lines.append("        set_path(patch, " + repr(path.split(".")) + ", " + repr(attribute) + ", values[" + repr(name) + "])")
+        lines.append("    return patch")
+
+        lines.append("def extract(patch):")
+        lines.append("    values = {}")
+        for path, attribute, name, omit_if_none in self.fields:
+            lookup = "patch['state']" + "".join("['children'][" + repr(p) + "]" for p in path.split(".")) + "[" + repr(attribute) + "]"
+            if omit_if_none:
+                lines.append("    try:")
+                lines.append("        values[" + repr(name) + "] = " + lookup)
+                lines.append("    except KeyError:")
+                lines.append("        values[" + repr(name) + "] = None")
+            else:
+                lines.append("    values[" + repr(name) + "] = " + lookup)
+        lines.append("    return values")
+
+        exec("\n".join(lines), namespace)
+        return namespace["build"], namespace["extract"]
+
+    @staticmethod
+    def get_node(root, path):
+
+        node = root
+        for part in path.split("."):
+            node = node[1].setdefault(part, [{}, {}])
+        return node
+
+    @staticmethod
+    def render_node(node):
+
+        items = [repr(attribute) + " : " + source for attribute, source in node[0].items()]
+        if len(node[1]) > 0:
+            items.append("'children' : {" + ", ".join(
+                repr(name) + " : " + ui_state_template.render_node(child) for name, child in node[1].items()
+            ) + "}")
+        return "{" + ", ".join(items) + "}"
+
+    @staticmethod
+    def set_path(patch, parts, attribute, value):
+
+        node = patch['state']
+        for part in parts:
+            node = node.setdefault('children', {}).setdefault(part, {})
+        node[attribute] = value
+
+    ## The serialized patch, as [static piece, value name, static piece, ...]
+    ## One skeleton is kept per set of omitted values and JSON backend
+    def get_skeleton(self, omitted):
+
+        key = (omitted, _json_backend.name)
+        skeleton = self._skeletons.get(key)
+        if skeleton is not None:
+            return skeleton
+
+        marker = "\u0001ui_state_template\u0001"
+        values = {name : (None if name in omitted else marker + name + marker) for name in self.names}
+        text = json_dumps(self.build(values))
+
+        skeleton = []
+        for i, part in enumerate(text.split(json_dumps(marker)[:-1])):
+            if i == 0:
+                skeleton.append(part)
+                continue
+            name, rest = part.split(json_dumps(marker)[1:], 1)
+            skeleton.append(name)
+            skeleton.append(rest)
+
+        self._skeletons[key] = skeleton
+        return skeleton
+
+    def dumps(self, values):
+
+        if not _json_backend.use_skeletons:
+            return json_dumps(self.build(values))
+
+        omitted = frozenset(
+            name for path, attribute, name, omit_if_none in self.fields
+            if omit_if_none and values[name] is None
+        )
+        skeleton = self.get_skeleton(omitted)
+
+        parts = [skeleton[0]]
+        for i in range(1, len(skeleton), 2):
+            parts.append(encode_json_value(values[skeleton[i]]))
+            parts.append(skeleton[i + 1])
+        return "".join(parts)
+
+    ## Serialize a full patch previously returned by build()
+    def dumps_patch(self, patch):
+
+        if not _json_backend.use_skeletons:
+            return json_dumps(patch)
+        return self.dumps(self.extract(patch))
+
+
+encode_json_string = json.encoder.encode_basestring_ascii
+
+
+## Scalars are encoded inline, anything else goes through the JSON backend
+def encode_json_value(value):
+
+    value_type = type(value)
+    if value_type is float and value - value == 0:
+        return repr(value)
+    if value_type is int:
+        return str(value)
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value_type is str:
+        return encode_json_string(value)
+    return json_dumps(value)
+
+
+DEFAULT_LOG_MAX_CHARS = 64 * 1024
+DEFAULT_LOG_MAX_RECORD_CHARS = 8 * 1024
+
+LOG_LEVELS = {
+    "DEBUG" : 10,
+    "INFO" : 20,
+    "WARNING" : 30,
+    "ERROR" : 40,
+}
+
+
+## A bounded buffer of log records, serialized once when the log is published
+## Once max_chars is exceeded the oldest records are dropped (ring buffer), and a
+## marker noting how many were dropped is written at the top of the log
+class log_buffer:
+
+    def __init__(
+            self,
+            max_chars=DEFAULT_LOG_MAX_CHARS,
+            max_record_chars=DEFAULT_LOG_MAX_RECORD_CHARS,
+            min_level="DEBUG",
+        ):
+
+        self.max_chars = max_chars
+        self.max_record_chars = max_record_chars
+        self.min_level = LOG_LEVELS[min_level]
+
+        self._records = collections.deque()
+        self._chars = 0
+        self.dropped = 0
+
+    def add(self, msg, level="INFO"):
+
+        if LOG_LEVELS.get(level, LOG_LEVELS["INFO"]) < self.min_level:
+            return
+
+        msg = str(msg)
+        if len(msg) > self.max_record_chars:
+            msg = msg[:self.max_record_chars] + "... (truncated " + str(len(msg) - self.max_record_chars) + " chars)"
+
+        self._records.append( (time.time(), level, msg) )
+        self._chars += len(msg)
+
+        while self._chars > self.max_chars and len(self._records) > 1:
+            dropped_record = self._records.popleft()
+            self._chars -= len(dropped_record[2])
+            self.dropped += 1
+
+    def get_records(self):
+        return list(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def serialize(self):
+
+        lines = []
+        if self.dropped > 0:
+            lines.append("... " + str(self.dropped) + " earlier log entries dropped ...")
+        for ts, level, msg in self._records:
+            lines.append(level + " " + msg)
+
+        return "\n".join(lines) + "\n"
+
+
+BATCH_PUBLISH_URL = "/ch/v1/publish/"
+
+## Endpoints found not to support BATCH_PUBLISH_URL
+_batch_publish_unavailable = {}
+
+
+OUTBOX_FILE_NAME = "outbox.sqlite3"
+DEFAULT_OUTBOX_FLUSH_SIZE = 100
+DEFAULT_OUTBOX_COALESCE_CHANNELS = ("ui_state",)
+DEFAULT_OUTBOX_MAX_ATTEMPTS = 10
+
+
+## Durable local spool for publishes that failed, or that have to wait behind ones
+## that did, kept in a SQLite database under `directory`
+## Messages are held per (endpoint, owner agent) and flushed in the order they were
+## spooled, in bulk where the batch publish endpoint is available
+## Publishes to coalesce_channels (state patches that are merged into the channel
+## aggregate) are merged into any patch already waiting for the same channel,
+## so a long outage doesn't build up a backlog of superseded patches
+## A message the API refuses outright (see is_retriable_error), or that has failed
+## max_attempts flushes in a row, is parked - kept in the database for inspection,
+## but no longer holding up the messages spooled after it
+class publish_outbox:
+
+    def __init__(self, directory, coalesce_channels=DEFAULT_OUTBOX_COALESCE_CHANNELS, max_attempts=DEFAULT_OUTBOX_MAX_ATTEMPTS):
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, OUTBOX_FILE_NAME)
+        self.coalesce_channels = tuple(coalesce_channels)
+        self.max_attempts = max_attempts
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "endpoint TEXT NOT NULL, "
+            "owner TEXT NOT NULL, "
+            "channel_id TEXT, "
+            "agent_id TEXT, "
+            "channel_name TEXT, "
+            "msg_str TEXT NOT NULL, "
+            "idempotency_key TEXT, "
+            "created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "parked INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT)"
+        )
+        ## Outboxes spooled to before messages could be parked
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(outbox)").fetchall()]
+        for name, definition in (("attempts", "INTEGER NOT NULL DEFAULT 0"), ("parked", "INTEGER NOT NULL DEFAULT 0"), ("error", "TEXT")):
+            if name not in columns:
+                self._db.execute("ALTER TABLE outbox ADD COLUMN " + name + " " + definition)
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_owner ON outbox (endpoint, owner, id)")
+
+    def count_pending(self, endpoint, owner):
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE endpoint = ? AND owner = ? AND parked = 0",
+                (endpoint, str(owner)),
+            ).fetchone()
+        return row[0]
+
+    def count_parked(self, endpoint, owner):
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE endpoint = ? AND owner = ? AND parked = 1",
+                (endpoint, str(owner)),
+            ).fetchone()
+        return row[0]
+
+    def has_pending(self, endpoint, owner):
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM outbox WHERE endpoint = ? AND owner = ? AND parked = 0 LIMIT 1",
+                (endpoint, str(owner)),
+            ).fetchone()
+        return row is not None
+
+    ## item is a dict with msg_str, channel_id and / or agent_id and channel_name,
+    ## and optionally idempotency_key - as taken by doover_api_iface.publish_batch
+    ## Messages without an idempotency key are given one, so a message can be sent
+    ## again by flush (after a batch that was partly published) without duplicating it
+    def add(self, endpoint, owner, item, error=None):
+
+        if error is not None:
+            self.last_error = str(error)
+        idempotency_key = item.get('idempotency_key')
+        if idempotency_key is None:
+            idempotency_key = "outbox-" + uuid.uuid4().hex
+
+        channel = (item.get('channel_id'), item.get('agent_id'), item.get('channel_name'))
+        with self._lock:
+            if item.get('channel_name') in self.coalesce_channels:
+                row = self._db.execute(
+                    "SELECT id, msg_str FROM outbox WHERE endpoint = ? AND owner = ? AND parked = 0 "
+                    "AND channel_id IS ? AND agent_id IS ? AND channel_name IS ? ORDER BY id DESC LIMIT 1",
+                    (endpoint, str(owner)) + channel,
+                ).fetchone()
+                merged = self.merge_patches(row[1], item['msg_str']) if row is not None else None
+                if merged is not None:
+                    self._db.execute(
+                        "UPDATE outbox SET msg_str = ?, idempotency_key = ? WHERE id = ?",
+                        (merged, idempotency_key, row[0]),
+                    )
+                    return
+
+            self._db.execute(
+                "INSERT INTO outbox (endpoint, owner, channel_id, agent_id, channel_name, msg_str, idempotency_key, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, str(owner)) + channel + (item['msg_str'], idempotency_key, time.time()),
+            )
+
+    ## The newer patch merged over the older one, or None if they aren't both JSON objects
+    @staticmethod
+    def merge_patches(older, newer):
+
+        try:
+            older = json_loads(older)
+            newer = json_loads(newer)
+        except ValueError:
+            return None
+        if not isinstance(older, dict) or not isinstance(newer, dict):
+            return None
+        return json_dumps(merge_state(older, newer))
+
+    ## The oldest `limit` spooled messages, as [(row id, item)]
+    def peek(self, endpoint, owner, limit=DEFAULT_OUTBOX_FLUSH_SIZE):
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, channel_id, agent_id, channel_name, msg_str, idempotency_key FROM outbox "
+                "WHERE endpoint = ? AND owner = ? AND parked = 0 ORDER BY id LIMIT ?",
+                (endpoint, str(owner), limit),
+            ).fetchall()
+
+        return [
+            (row[0], {
+                "channel_id" : row[1],
+                "agent_id" : row[2],
+                "channel_name" : row[3],
+                "msg_str" : row[4],
+                "idempotency_key" : row[5],
+            })
+            for row in rows
+        ]
+
+    def remove(self, row_ids):
+
+        if len(row_ids) == 0:
+            return
+        with self._lock:
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in row_ids])
+
+    ## Count a failed attempt to publish a spooled message, parking it if it isn't
+    ## worth retrying or has run out of attempts - returns whether it was parked
+    def record_failure(self, row_id, error):
+
+        self.last_error = str(error)
+        ## Nothing was sent, so it doesn't count against the message
+        if isinstance(error, circuit_open_error):
+            return False
+
+        retriable = is_retriable_error(error)
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET attempts = attempts + 1, error = ?, "
+                "parked = CASE WHEN ? OR attempts + 1 >= ? THEN 1 ELSE 0 END WHERE id = ?",
+                (str(error), not retriable, self.max_attempts, row_id),
+            )
+            row = self._db.execute("SELECT parked FROM outbox WHERE id = ?", (row_id,)).fetchone()
+        return row is not None and row[0] == 1
+
+    ## Publish everything spooled for api_client's agent, oldest first
+    ## Messages the API refuses are parked and skipped - anything else stops the
+    ## flush (raising) at the first failure, leaving the rest spooled
+    ## Returns the number of messages published
+    def flush(self, api_client, limit=DEFAULT_OUTBOX_FLUSH_SIZE, use_batch=True):
+
+        total = 0
+        while True:
+            rows = self.peek(api_client.endpoint, api_client.agent_id, limit)
+            if len(rows) == 0:
+                return total
+
+            items = [item for row_id, item in rows]
+            if use_batch and len(items) > 1:
+                try:
+                    results = api_client.publish_batch(items)
+                except Exception as e:
+                    if is_retriable_error(e):
+                        self.record_failure(rows[0][0], e)
+                        raise
+                    ## Something in the batch was refused - publish them one at a
+                    ## time below to find out which
+                    results = None
+                if results is not None:
+                    self.remove([row_id for row_id, item in rows])
+                    total += len(rows)
+                    continue
+
+            for row_id, item in rows:
+                try:
+                    api_client.publish_to_channel(**item)
+                except Exception as e:
+                    self.record_failure(row_id, e)
+                    if is_retriable_error(e):
+                        raise
+                    continue
+                self.remove([row_id])
+                total += 1
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+## One outbox per directory, shared by every client in the process
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_publish_outbox(directory, **kwargs):
+
+    directory = os.path.abspath(directory)
+    with _outboxes_lock:
+        if directory not in _outboxes:
+            _outboxes[directory] = publish_outbox(directory, **kwargs)
+        return _outboxes[directory]
+
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 0.25
+DEFAULT_BACKOFF_MAX = 4.0
+
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET_TIMEOUT = 30.0
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class circuit_open_error(Exception):
+    pass
+
+
+## A publish the API answered with something other than 200 - status is the HTTP
+## status code, or None if there was no response at all
+class publish_error(Exception):
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+## Whether a failed publish is worth trying again later (the API was unreachable,
+## overloaded or failing) rather than one that will fail the same way every time,
+## like a 400 for a bad message or a 404 for a deleted channel
+def is_retriable_error(e):
+
+    if isinstance(e, (circuit_open_error, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, publish_error):
+        return e.status is None or e.status in RETRY_STATUS_CODES or e.status >= 500
+    return False
+
+
+## Fails calls to an endpoint fast once it has failed `threshold` times in a row,
+## instead of having every caller wait through its retries. After reset_timeout a
+## single trial call is let through (half open) while other callers keep failing
+## fast - success closes the circuit again, failure re-opens it
+## A trial that never reports back (it raised something else) stops blocking new
+## trials after another reset_timeout
+class circuit_breaker:
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.reset_timeout
+
+    def check(self, endpoint=""):
+
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.time()
+            if now - self.opened_at < self.reset_timeout:
+                raise circuit_open_error("Circuit open for " + str(endpoint) + " after " + str(self.failures) + " consecutive failures")
+            if self.trial_started_at is not None and now - self.trial_started_at < self.reset_timeout:
+                raise circuit_open_error("Circuit half open for " + str(endpoint) + " - waiting on a trial call")
+            ## Half open - let this call through as the trial
+            self.trial_started_at = now
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_started_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self.trial_started_at = None
+
+
+## One breaker per endpoint, shared by every client in the process
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint):
+
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(endpoint)
+        if breaker is None:
+            breaker = circuit_breaker()
+            _circuit_breakers[endpoint] = breaker
+
+    return breaker
+
+
+## The API url with ids replaced by placeholders, so calls can be grouped
+## e.g. /ch/v1/agent/<id>/ui_cmds/ -> /ch/v1/agent/{agent_id}/ui_cmds/
+URL_ID_PLACEHOLDERS = {
+    "agent" : "{agent_id}",
+    "channel" : "{channel_id}",
+    "message" : "{message_id}",
+}
+
+def get_url_template(url):
+
+    parts = url.split("/")
+    for i in range(len(parts) - 1):
+        placeholder = URL_ID_PLACEHOLDERS.get(parts[i])
+        if placeholder is not None and parts[i + 1] != "":
+            parts[i + 1] = placeholder
+    return "/".join(parts)
+
+
+## The timing and size of a single API call, as passed to tracers
+class request_record:
+
+    __slots__ = ("method", "url", "url_template", "status", "latency", "request_bytes", "response_bytes", "error")
+
+    def __init__(self, method, url, data=None):
+
+        self.method = method
+        self.url = url
+        self.url_template = get_url_template(url)
+        self.status = None
+        self.latency = None
+        self.request_bytes = 0
+        if data is not None:
+            self.request_bytes = len(data.encode() if isinstance(data, str) else data)
+        self.response_bytes = 0
+        self.error = None
+
+
+## Base class for tracers that can be attached to a doover_api_iface with add_tracer
+## before_request is called with the method and url before each call, and
+## after_request with its request_record once it has completed (or failed)
+class request_tracer:
+
+    def before_request(self, method, url):
+        pass
+
+    def after_request(self, record):
+        pass
+
+
+## Keeps every request_record and summarizes them by (method, url_template)
+class timing_tracer(request_tracer):
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def after_request(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def get_breakdown(self):
+
+        breakdown = {}
+        with self._lock:
+            for r in self.records:
+                key = (r.method, r.url_template)
+                entry = breakdown.setdefault(key, {"calls" : 0, "latency" : 0.0, "request_bytes" : 0, "response_bytes" : 0, "errors" : 0})
+                entry["calls"] += 1
+                entry["latency"] += r.latency or 0.0
+                entry["request_bytes"] += r.request_bytes
+                entry["response_bytes"] += r.response_bytes
+                if r.error is not None or r.status != 200:
+                    entry["errors"] += 1
+
+        return breakdown
+
+    def format_breakdown(self):
+
+        lines = []
+        total = 0.0
+        for (method, url_template), entry in sorted(self.get_breakdown().items(), key=lambda i: -i[1]["latency"]):
+            total += entry["latency"]
+            line = "%s %s x%d %.1fms %dB sent %dB recv" % (
+                method, url_template, entry["calls"], entry["latency"] * 1000, entry["request_bytes"], entry["response_bytes"],
+            )
+            if entry["errors"] > 0:
+                line += " " + str(entry["errors"]) + " errors"
+            lines.append(line)
+        lines.insert(0, "API calls : %d in %.1fms" % (len(self.records), total * 1000))
+
+        return "\n".join(lines)
 
 
 class doover_api_iface:
@@ -12,6 +1053,14 @@ class doover_api_iface:
             endpoint="https://my.doover.dev",
             debug_mode=False,
             verify=True,
+            session=None,
+            pool_size=DEFAULT_POOL_SIZE,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT,
+            keep_alive=True,
+            max_retries=DEFAULT_MAX_RETRIES,
+            backoff_base=DEFAULT_BACKOFF_BASE,
+            backoff_max=DEFAULT_BACKOFF_MAX,
         ):
 
         self.agent_id = agent_id
@@ -19,18 +1068,113 @@ class doover_api_iface:
         
         self.endpoint = endpoint
 
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
         self.debug_mode = debug_mode
         self.verify = verify
 
+        if session is None:
+            session = get_shared_session(pool_size=pool_size, keep_alive=keep_alive)
+        self.session = session
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.tracers = []
+        self.outbox = None
+
     def set_access_token(self, access_token):
         self.access_token = access_token
 
+    def set_outbox(self, outbox):
+        self.outbox = outbox
+
     def get_headers(self):
         return {"Authorization": "Token " + str(self.access_token)}
 
-    def make_get_request(self, url, data=None):
+    def get_timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def add_tracer(self, tracer):
+        self.tracers.append(tracer)
+
+    def remove_tracer(self, tracer):
+        if tracer in self.tracers:
+            self.tracers.remove(tracer)
+
+    def send_request(self, method, url, data=None, params=None, headers=None):
+
         full_url = self.endpoint + url
-        r = requests.get(full_url, data=data, headers=self.get_headers(), verify=self.verify)
+        if headers is None:
+            headers = self.get_headers()
+        if len(self.tracers) == 0:
+            return self.session.request(method, full_url, data=data, params=params, headers=headers, verify=self.verify, timeout=self.get_timeout())
+
+        for tracer in self.tracers:
+            tracer.before_request(method, url)
+
+        record = request_record(method, url, data)
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, full_url, data=data, params=params, headers=headers, verify=self.verify, timeout=self.get_timeout())
+        except Exception as e:
+            record.latency = time.perf_counter() - start
+            record.error = str(e)
+            for tracer in self.tracers:
+                tracer.after_request(record)
+            raise
+
+        record.latency = time.perf_counter() - start
+        record.status = r.status_code
+        record.response_bytes = len(r.content)
+        for tracer in self.tracers:
+            tracer.after_request(record)
+
+        return r
+
+    ## Full jitter exponential backoff before retry number `attempt` (from 1)
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    ## Send a request, retrying connection errors and transient (5xx / 429) responses
+    ## GETs are always retried, POSTs only when they carry an idempotency key, so
+    ## that a retry can never publish the same message twice
+    def request_with_retry(self, method, url, data=None, params=None, idempotency_key=None):
+
+        headers = self.get_headers()
+        if idempotency_key is not None:
+            headers["Idempotency-Key"] = str(idempotency_key)
+        retriable = method == "GET" or idempotency_key is not None
+
+        breaker = get_circuit_breaker(self.endpoint)
+        attempt = 0
+        while True:
+            breaker.check(self.endpoint)
+
+            error = None
+            try:
+                r = self.send_request(method, url, data=data, params=params, headers=headers)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                r = None
+                error = e
+
+            if r is not None and r.status_code not in RETRY_STATUS_CODES:
+                breaker.record_success()
+                return r
+
+            breaker.record_failure()
+            if not retriable or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return r
+
+            attempt += 1
+            time.sleep(self.get_backoff(attempt))
+
+    def make_get_request(self, url, data=None, params=None):
+        r = self.request_with_retry("GET", url, data=data, params=params)
         if r.status_code == 200:
             if self.debug_mode:
                 print(r.text)
@@ -41,9 +1185,8 @@ class doover_api_iface:
             return None
 
 
-    def make_post_request(self, url, data=None):
-        full_url = self.endpoint + url
-        r = requests.post(full_url, data=data, headers=self.get_headers(), verify=self.verify)
+    def make_post_request(self, url, data=None, idempotency_key=None):
+        r = self.request_with_retry("POST", url, data=data, idempotency_key=idempotency_key)
         if r.status_code == 200:
             if self.debug_mode:
                 print(r.text)
@@ -62,10 +1205,10 @@ class doover_api_iface:
             data=None,
         )
 
-        return json.loads( res.text )
+        return json_loads( res.content )
 
     
-    def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None):
+    def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None, fetch_mode=FETCH_ALL):
 
         if channel_id is not None:
             url = '/ch/v1/channel/' + str(channel_id) + '/'
@@ -81,25 +1224,63 @@ class doover_api_iface:
             }
             raise Exception("Incorrect arguments supplied to get_channel_details : " + str(args))
 
-        res = json.loads( 
-            self.make_get_request(
-                url=url,
-                data=None,
-            ).text
-        )
+        if fetch_mode not in (FETCH_ALL, FETCH_AGGREGATE, FETCH_MESSAGES):
+            raise Exception("Unknown fetch_mode supplied to get_channel_details : " + str(fetch_mode))
+
+        ## Only download what was asked for - the message list in particular can be large
+        res = {}
+        if fetch_mode in (FETCH_ALL, FETCH_AGGREGATE):
+            res = json_loads( 
+                self.make_get_request(
+                    url=url,
+                    data=None,
+                ).content
+            )
 
-        msgs_res = json.loads(
-            self.make_get_request(
-                url=msgs_url,
-                data=None,
-            ).text
-        )
+        if fetch_mode in (FETCH_ALL, FETCH_MESSAGES):
+            msgs_res = json_loads(
+                self.make_get_request(
+                    url=msgs_url,
+                    data=None,
+                ).content
+            )
 
-        res['messages'] = msgs_res['messages']
+            res['messages'] = msgs_res['messages']
 
         return res
 
     
+    def get_channel_messages_page(self, channel_id=None, agent_id=None, channel_name=None, page_size=DEFAULT_PAGE_SIZE, before=None, since=None, until=None):
+
+        if channel_id is not None:
+            url = '/ch/v1/channel/' + str(channel_id) + '/messages/'
+        elif agent_id is not None and channel_name is not None:
+            url = "/ch/v1/agent/" + str(agent_id) + "/" + str(channel_name) + "/messages/"
+        else:
+            args = {
+                "channel_id" : channel_id,
+                "agent_id" : agent_id,
+                "channel_name" : channel_name,
+            }
+            raise Exception("Incorrect arguments supplied to get_channel_messages_page : " + str(args))
+
+        params = {"limit" : page_size}
+        if before is not None:
+            params["before"] = before
+        if since is not None:
+            params["since"] = since
+        if until is not None:
+            params["until"] = until
+
+        res = self.make_get_request(
+            url=url,
+            data=None,
+            params=params,
+        )
+
+        return json_loads( res.content )['messages']
+
+    
     def get_message_details(self, channel_id, message_id):
 
         url = '/ch/v1/channel/' + str(channel_id) + '/message/' + str(message_id) #+ "/"
@@ -108,10 +1289,10 @@ class doover_api_iface:
             data=None,
         )
 
-        return json.loads( res.text )
+        return json_loads( res.content )
 
 
-    def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None):
+    def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None, idempotency_key=None):
 
         if channel_id is not None:
             url = '/ch/v1/channel/' + str(channel_id) + '/'
@@ -126,10 +1307,15 @@ class doover_api_iface:
             raise Exception("Incorrect arguments supplied to publish_to_channel : " + str(args))
 
           
-        res = self.make_post_request(
-            url=url,
-            data=msg_str,
-        ).text
+        ## Not make_post_request, so a failure keeps its status code
+        res = self.request_with_retry("POST", url, data=msg_str, idempotency_key=idempotency_key)
+        if res.status_code != 200:
+            print("ERROR : " + str(res.status_code))
+            print(res.text)
+            raise publish_error("Failed to publish to channel : " + url + " : " + str(res.status_code), status=res.status_code)
+        if self.debug_mode:
+            print(res.text)
+        res = res.text
 
         output = {
             'msg_id' : res
@@ -138,19 +1324,127 @@ class doover_api_iface:
         return output
 
 
+    ## publish_to_channel, but with an outbox set the message is spooled rather than
+    ## lost if the publish fails in a way that is worth retrying (see is_retriable_error)
+    ## - or without trying, if earlier spooled messages are still waiting, so channels
+    ## keep seeing messages in order. Other failures are raised as usual
+    ## Returns None when the message was spooled
+    def publish_or_spool(self, msg_str, channel_id=None, agent_id=None, channel_name=None, idempotency_key=None):
+
+        item = {
+            "msg_str" : msg_str,
+            "channel_id" : channel_id,
+            "agent_id" : agent_id,
+            "channel_name" : channel_name,
+            "idempotency_key" : idempotency_key,
+        }
+
+        outbox = self.outbox
+        if outbox is None:
+            return self.publish_to_channel(**item)
+
+        error = None
+        if not outbox.has_pending(self.endpoint, self.agent_id):
+            try:
+                return self.publish_to_channel(**item)
+            except Exception as e:
+                if not is_retriable_error(e):
+                    raise
+                error = e
+
+        outbox.add(self.endpoint, self.agent_id, item, error=error)
+        return None
+
+    def spool_many(self, items, error=None):
+        for item in items:
+            self.outbox.add(self.endpoint, self.agent_id, item, error=error)
+
+    def flush_outbox(self, use_batch=True):
+
+        if self.outbox is None:
+            return 0
+        return self.outbox.flush(self, use_batch=use_batch)
+
+
+    ## Publish several messages in a single round trip with the batch publish
+    ## endpoint. Each item is a dict with msg_str, channel_id or agent_id and
+    ## channel_name, and optionally idempotency_key
+    ## Returns the list of outputs in item order, or None if the endpoint isn't
+    ## available on this server (which is remembered, so it is only tried once)
+    def publish_batch(self, items):
+
+        if _batch_publish_unavailable.get(self.endpoint, False):
+            return None
+
+        messages = []
+        for item in items:
+            message = {"payload" : item['msg_str']}
+            if item.get('channel_id') is not None:
+                message["channel"] = item['channel_id']
+            elif item.get('agent_id') is not None and item.get('channel_name') is not None:
+                message["agent"] = item['agent_id']
+                message["channel_name"] = item['channel_name']
+            else:
+                raise Exception("Incorrect arguments supplied to publish_batch : " + str(item))
+            if item.get('idempotency_key') is not None:
+                message["idempotency_key"] = item['idempotency_key']
+            messages.append(message)
+
+        ## The batch can only be retried safely if every message in it can be
+        batch_key = None
+        keys = [m.get("idempotency_key") for m in messages]
+        if len(keys) > 0 and None not in keys:
+            batch_key = hashlib.sha256(":".join(keys).encode()).hexdigest()
+
+        r = self.request_with_retry(
+            "POST",
+            BATCH_PUBLISH_URL,
+            data=json_dumps({"messages" : messages}),
+            idempotency_key=batch_key,
+        )
+        if r is not None and self.is_batch_unavailable(r):
+            _batch_publish_unavailable[self.endpoint] = True
+            return None
+        if r is None or r.status_code != 200:
+            status = None if r is None else r.status_code
+            raise publish_error("Failed to publish batch : " + str(status), status=status)
+
+        return [{'msg_id' : msg_id} for msg_id in json_loads(r.content)['results']]
+
+    ## Whether a batch publish response means the server has no batch endpoint, rather
+    ## than that something in the batch was refused - a 404 for a message's channel
+    ## comes back with a JSON error body, a 404 for the route itself doesn't
+    @staticmethod
+    def is_batch_unavailable(r):
+
+        if r.status_code in (405, 501):
+            return True
+        if r.status_code != 404:
+            return False
+        try:
+            return not isinstance(json_loads(r.content), dict)
+        except ValueError:
+            return True
+
+
 class message_log:
 
+    ## Channels can hold a very large number of these, so keep them small
+    __slots__ = ("api_client", "channel_id", "message_id", "timestamp", "json_result")
+
     def __init__(
             self,
             api_client,
             channel_id=None,
             message_id=None,
+            timestamp=None,
         ):
 
         self.api_client = api_client
 
         self.channel_id = channel_id
         self.message_id = message_id
+        self.timestamp = timestamp
         self.json_result = None
 
 
@@ -192,60 +1486,188 @@ class channel:
         self.json_result = None
 
 
-    def update(self):
+    def update(self, fetch_mode=FETCH_ALL):
 
         result = self.api_client.get_channel_details(
             channel_id=self.channel_id,
             agent_id=self.agent_id,
             channel_name=self.channel_name,
+            fetch_mode=fetch_mode,
         )
 
-        self.json_result = result
+        self.set_result(result, fetch_mode)
 
-        self.channel_id = result['channel']
-        self.agent_id = result['owner']
-        self.channel_name = result['name']
 
+    def set_result(self, result, fetch_mode=FETCH_ALL):
 
-    def get_aggregate(self):
+        ## A partial fetch is merged into what we already have
+        if self.json_result is None or fetch_mode == FETCH_ALL:
+            self.json_result = result
+        else:
+            self.json_result.update(result)
 
-        if self.json_result is None:
-            self.update()
+        if 'channel' in result:
+            self.channel_id = result['channel']
+            self.agent_id = result['owner']
+            self.channel_name = result['name']
+
+
+    def get_aggregate(self, cache_ttl=None):
+
+        ## With a cache_ttl, a fresh entry in the process aggregate cache is used
+        ## instead of fetching, and anything fetched is stored there
+        if cache_ttl is not None:
+            cached = self.get_cached_aggregate()
+            if cached is not None:
+                return cached
+
+        if self.json_result is None or 'aggregate' not in self.json_result:
+            self.update(fetch_mode=FETCH_AGGREGATE)
+
+        payload = self.json_result['aggregate']['payload']
+        if cache_ttl is not None:
+            self.set_cached_aggregate(payload, cache_ttl)
+
+        return payload
+
+
+    def refresh_aggregate(self, cache_ttl=None):
+
+        self.update(fetch_mode=FETCH_AGGREGATE)
+
+        payload = self.json_result['aggregate']['payload']
+        self.set_cached_aggregate(payload, cache_ttl)
+
+        return payload
 
-        return self.json_result['aggregate']['payload']
+
+    def get_cache_key(self):
+        if self.channel_name is not None:
+            return self.channel_name
+        return self.channel_id
+
+    def get_cached_aggregate(self):
+        return _aggregate_cache.get(self.agent_id, self.get_cache_key())
+
+    def set_cached_aggregate(self, payload, cache_ttl=None):
+        _aggregate_cache.set(self.agent_id, self.get_cache_key(), payload, ttl=cache_ttl)
+
+    def invalidate_cached_aggregate(self):
+        _aggregate_cache.invalidate(self.agent_id, self.get_cache_key())
 
 
     def get_messages(self):
 
-        if self.json_result is None:
-            self.update()
+        if self.json_result is None or 'messages' not in self.json_result:
+            self.update(fetch_mode=FETCH_MESSAGES)
 
         messages = self.json_result['messages']
+
+        ## The listing doesn't carry the channel details - a channel opened by
+        ## agent_id / channel_name needs its id for the messages' own URLs
+        if self.channel_id is None and any(m.get('channel') is None for m in messages):
+            self.update(fetch_mode=FETCH_AGGREGATE)
+
         result = []
         for m in messages:
 
             message_id = m['message']
             agent_id = m['agent']
-            channel_id = self.channel_id
+            channel_id = m.get('channel', self.channel_id)
 
             new_message = message_log(
                 api_client=self.api_client,
                 channel_id=channel_id,
                 message_id=message_id,
+                timestamp=m.get('timestamp'),
             )
 
             result.append(new_message)
 
         return result
+
+
+    ## Fetch the details of many messages concurrently over a bounded thread pool
+    ## (sharing the pooled session) instead of one sequential GET per get_payload()
+    ## Each message_log's json_result is filled in, and the payloads are returned
+    ## in the same order as the messages passed in
+    def fetch_payloads(self, messages, max_workers=DEFAULT_POOL_SIZE):
+
+        messages = list(messages)
+        pending = [m for m in messages if m.json_result is None]
+
+        if len(pending) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+                for m, result in zip(pending, executor.map(self.fetch_message_details, pending)):
+                    m.json_result = result
+
+        return [m.json_result['payload'] for m in messages]
+
+
+    def fetch_message_details(self, message):
+
+        return self.api_client.get_message_details(
+            channel_id=message.channel_id,
+            message_id=message.message_id,
+        )
+
+
+    ## Lazily page through the channel's messages, fetching each page only when
+    ## the previous one has been consumed, so memory stays flat however long the
+    ## channel history is. since / until are passed through to the API as is
+    def iter_messages(self, since=None, until=None, page_size=DEFAULT_PAGE_SIZE):
+
+        before = None
+        previous_ids = set()
+        while True:
+
+            page = self.api_client.get_channel_messages_page(
+                channel_id=self.channel_id,
+                agent_id=self.agent_id,
+                channel_name=self.channel_name,
+                page_size=page_size,
+                before=before,
+                since=since,
+                until=until,
+            )
+
+            ## Only the previous page is remembered, so memory stays bounded by the
+            ## page size - that is enough to catch an endpoint that ignores the
+            ## cursor (the same page again) or includes the cursor message itself
+            ## Stopping there would quietly drop the rest of the channel history
+            page_ids = set(m['message'] for m in page)
+            new_messages = [m for m in page if m['message'] not in previous_ids]
+            if len(page) > 0 and len(new_messages) == 0:
+                raise Exception("Channel messages endpoint ignored the before cursor " + str(before) + " - can't page past " + str(len(previous_ids)) + " messages")
+
+            for m in new_messages:
+                message = message_log(
+                    api_client=self.api_client,
+                    channel_id=m.get('channel', self.channel_id),
+                    message_id=m['message'],
+                    timestamp=m.get('timestamp'),
+                )
+                ## Some endpoints include the payload in the listing - no need to fetch it again
+                if 'payload' in m:
+                    message.json_result = m
+                yield message
+
+            ## A short page is the last one
+            if len(page) < page_size or len(page) == 0:
+                return
+
+            before = page[-1]['message']
+            previous_ids = page_ids
  
 
-    def publish(self, msg_str, save_log=True, log_aggregate=False ):
+    def publish(self, msg_str, save_log=True, log_aggregate=False, idempotency_key=None ):
 
-        result = self.api_client.publish_to_channel(
+        result = self.api_client.publish_or_spool(
             msg_str=msg_str,
             channel_id=self.channel_id,
             agent_id=self.agent_id,
             channel_name=self.channel_name,
+            idempotency_key=idempotency_key,
         )
 
         return result
@@ -306,6 +1728,14 @@ class doover_iface:
             endpoint="https://my.doover.dev",
             debug_mode=False,
             verify_ssl=True,
+            session=None,
+            pool_size=DEFAULT_POOL_SIZE,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT,
+            keep_alive=True,
+            max_retries=DEFAULT_MAX_RETRIES,
+            backoff_base=DEFAULT_BACKOFF_BASE,
+            backoff_max=DEFAULT_BACKOFF_MAX,
         ):
 
         self.agent_id = agent_id
@@ -322,8 +1752,27 @@ class doover_iface:
             endpoint=endpoint,
             debug_mode=debug_mode,
             verify=verify_ssl,
+            session=session,
+            pool_size=pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            keep_alive=keep_alive,
+            max_retries=max_retries,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
         )
 
+    def set_access_token(self, access_token):
+        self.access_token = access_token
+        self.api_client.set_access_token(access_token)
+
+    def set_outbox(self, outbox):
+        self.api_client.set_outbox(outbox)
+
+    ## Publish anything spooled for this agent - returns the number published
+    def flush_outbox(self, use_batch=True):
+        return self.api_client.flush_outbox(use_batch=use_batch)
+
     def get_agent(self, agent_id):
 
         return agent(
@@ -338,4 +1787,332 @@ class doover_iface:
             channel_name=channel_name,
             agent_id=agent_id,
             api_client=self.api_client
-        )
\ No newline at end of file
+        )
+
+    ## Publish to several channels at once - publishes is a list of
+    ## (channel, msg_str) or (channel, msg_str, idempotency_key)
+    ## Uses the batch publish endpoint when the server has one, otherwise publishes
+    ## concurrently over the pooled session (in order within each channel)
+    ## Returns the {'msg_id' : ...} outputs in the same order as publishes - with an
+    ## outbox set, messages that were spooled instead have None
+    def publish_many(self, publishes, use_batch=True, max_workers=DEFAULT_POOL_SIZE):
+
+        items = []
+        for p in publishes:
+            c, msg_str = p[0], p[1]
+            items.append({
+                "channel" : c,
+                "msg_str" : msg_str,
+                "channel_id" : c.channel_id,
+                "agent_id" : c.agent_id,
+                "channel_name" : c.channel_name,
+                "idempotency_key" : p[2] if len(p) > 2 else None,
+            })
+
+        if len(items) == 0:
+            return []
+
+        ## Queue behind anything still waiting in the outbox
+        outbox = self.api_client.outbox
+        if outbox is not None and outbox.has_pending(self.api_client.endpoint, self.api_client.agent_id):
+            self.api_client.spool_many(items)
+            return [None] * len(items)
+
+        results = None
+        if use_batch and len(items) > 1:
+            try:
+                results = self.api_client.publish_batch(items)
+            except Exception as e:
+                if not is_retriable_error(e):
+                    ## Refused (a bad item, or a route this server handles differently)
+                    ## - fall back to publishing per channel, as publish_outbox.flush does
+                    results = None
+                elif outbox is None:
+                    raise
+                else:
+                    self.api_client.spool_many(items, error=e)
+                    return [None] * len(items)
+            if results is not None:
+                return results
+
+        ## Group by channel so each channel still sees its messages in order
+        groups = collections.OrderedDict()
+        for i, item in enumerate(items):
+            key = (item['channel_id'], item['agent_id'], item['channel_name'])
+            groups.setdefault(key, []).append(i)
+
+        results = [None] * len(items)
+
+        def publish_group(indexes):
+            for i in indexes:
+                item = items[i]
+                results[i] = item['channel'].publish(
+                    msg_str=item['msg_str'],
+                    idempotency_key=item['idempotency_key'],
+                )
+
+        if len(groups) == 1:
+            publish_group(list(groups.values())[0])
+            return results
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            for future in [executor.submit(publish_group, indexes) for indexes in groups.values()]:
+                future.result()
+
+        return results
+
+
+
+## Asyncio counterparts of the classes above
+## Requests are still made through the pooled (sync) doover_api_iface, but are
+## run in an executor so independent calls can be awaited concurrently
+
+class async_doover_api_iface:
+
+    def __init__(
+            self,
+            api_client=None,
+            executor=None,
+            **kwargs
+        ):
+
+        if api_client is None:
+            api_client = doover_api_iface(**kwargs)
+        self.api_client = api_client
+        self.executor = executor
+
+    @property
+    def agent_id(self):
+        return self.api_client.agent_id
+
+    def set_access_token(self, access_token):
+        self.api_client.set_access_token(access_token)
+
+    def add_tracer(self, tracer):
+        self.api_client.add_tracer(tracer)
+
+    def remove_tracer(self, tracer):
+        self.api_client.remove_tracer(tracer)
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    async def get_agent_details(self, agent_id):
+        return await self.run_in_executor(self.api_client.get_agent_details, agent_id)
+
+    async def get_channel_details(self, channel_id=None, agent_id=None, channel_name=None, fetch_mode=FETCH_ALL):
+        return await self.run_in_executor(
+            self.api_client.get_channel_details,
+            channel_id=channel_id,
+            agent_id=agent_id,
+            channel_name=channel_name,
+            fetch_mode=fetch_mode,
+        )
+
+    async def get_message_details(self, channel_id, message_id):
+        return await self.run_in_executor(
+            self.api_client.get_message_details,
+            channel_id=channel_id,
+            message_id=message_id,
+        )
+
+    async def publish_to_channel(self, msg_str, channel_id=None, agent_id=None, channel_name=None, idempotency_key=None):
+        return await self.run_in_executor(
+            self.api_client.publish_to_channel,
+            msg_str=msg_str,
+            channel_id=channel_id,
+            agent_id=agent_id,
+            channel_name=channel_name,
+            idempotency_key=idempotency_key,
+        )
+
+    async def publish_or_spool(self, msg_str, channel_id=None, agent_id=None, channel_name=None, idempotency_key=None):
+        return await self.run_in_executor(
+            self.api_client.publish_or_spool,
+            msg_str=msg_str,
+            channel_id=channel_id,
+            agent_id=agent_id,
+            channel_name=channel_name,
+            idempotency_key=idempotency_key,
+        )
+
+
+class async_channel:
+
+    def __init__(
+            self,
+            api_client,
+            channel_id=None,
+            agent_id=None,
+            channel_name=None,
+        ):
+
+        self.api_client = api_client
+
+        self.channel_id = channel_id
+
+        self.agent_id = agent_id
+        self.channel_name = channel_name
+
+        self.json_result = None
+
+    set_result = channel.set_result
+
+
+    async def update(self, fetch_mode=FETCH_ALL):
+
+        result = await self.api_client.get_channel_details(
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            fetch_mode=fetch_mode,
+        )
+
+        self.set_result(result, fetch_mode)
+
+
+    get_cache_key = channel.get_cache_key
+    get_cached_aggregate = channel.get_cached_aggregate
+    set_cached_aggregate = channel.set_cached_aggregate
+    invalidate_cached_aggregate = channel.invalidate_cached_aggregate
+
+
+    async def get_aggregate(self, cache_ttl=None):
+
+        if cache_ttl is not None:
+            cached = self.get_cached_aggregate()
+            if cached is not None:
+                return cached
+
+        if self.json_result is None or 'aggregate' not in self.json_result:
+            await self.update(fetch_mode=FETCH_AGGREGATE)
+
+        payload = self.json_result['aggregate']['payload']
+        if cache_ttl is not None:
+            self.set_cached_aggregate(payload, cache_ttl)
+
+        return payload
+
+
+    async def refresh_aggregate(self, cache_ttl=None):
+
+        await self.update(fetch_mode=FETCH_AGGREGATE)
+
+        payload = self.json_result['aggregate']['payload']
+        self.set_cached_aggregate(payload, cache_ttl)
+
+        return payload
+
+
+    async def publish(self, msg_str, save_log=True, log_aggregate=False, idempotency_key=None ):
+
+        result = await self.api_client.publish_or_spool(
+            msg_str=msg_str,
+            channel_id=self.channel_id,
+            agent_id=self.agent_id,
+            channel_name=self.channel_name,
+            idempotency_key=idempotency_key,
+        )
+
+        return result
+
+
+class async_doover_iface:
+
+    def __init__(
+            self,
+            agent_id=None,
+            access_token=None,
+            endpoint="https://my.doover.dev",
+            debug_mode=False,
+            verify_ssl=True,
+            executor=None,
+            **kwargs
+        ):
+
+        self.agent_id = agent_id
+        self.access_token = access_token
+
+        self.endpoint = endpoint
+        self.debug_mode = debug_mode
+        self.verify_ssl = verify_ssl
+
+        self.api_client = async_doover_api_iface(
+            executor=executor,
+            agent_id=agent_id,
+            access_token=access_token,
+            endpoint=endpoint,
+            debug_mode=debug_mode,
+            verify=verify_ssl,
+            **kwargs
+        )
+
+    def set_access_token(self, access_token):
+        self.access_token = access_token
+        self.api_client.set_access_token(access_token)
+
+    def get_channel(self, channel_id=None, channel_name=None, agent_id=None):
+
+        return async_channel(
+            channel_id=channel_id,
+            channel_name=channel_name,
+            agent_id=agent_id,
+            api_client=self.api_client
+        )
+
+
+
+## Clients are kept at module level, keyed by (endpoint, agent_id), so that warm
+## invocations of the same container reuse them - only the access token changes
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_doover_client(agent_id=None, access_token=None, endpoint="https://my.doover.dev", **kwargs):
+
+    key = (endpoint, agent_id)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = doover_iface(
+                agent_id=agent_id,
+                access_token=access_token,
+                endpoint=endpoint,
+                **kwargs
+            )
+            _clients[key] = client
+        else:
+            client.set_access_token(access_token)
+
+    return client
+
+
+def get_async_doover_client(agent_id=None, access_token=None, endpoint="https://my.doover.dev", **kwargs):
+
+    key = (endpoint, agent_id)
+    with _clients_lock:
+        client = _async_clients.get(key)
+        if client is None:
+            client = async_doover_iface(
+                agent_id=agent_id,
+                access_token=access_token,
+                endpoint=endpoint,
+                **kwargs
+            )
+            _async_clients[key] = client
+        else:
+            client.set_access_token(access_token)
+
+    return client
+
+
+def clear_doover_clients():
+
+    with _clients_lock:
+        _clients.clear()
+        _async_clients.clear()
@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+import collections, threading, math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+## Decoding of the short-key payloads sent by Rypar devices
+##
+## The payload schema is declared once below, and compiled into a decoder that
+## produces a slotted rypar_uplink record. All problems with a payload are
+## collected in a single pass rather than failing on the first missing key
+
+
+## Coercions used in the schema - None passes the value through as is
+def to_float(value):
+    return float(value)
+
+def to_int(value):
+    return int(value)
+
+## str() would turn a missing (None) value into "None" - fail it like the others do
+def to_str(value):
+    if value is None:
+        raise TypeError("expected a value, got None")
+    return str(value)
+
+
+## (record attribute, payload key, coercion, required, default)
+RYPAR_UPLINK_SCHEMA = [
+    ## A string, so it is the same key wherever per device state is kept (and as
+    ## it comes back from a JSON state channel) whether a device sends it quoted or not
+    ("device_id", "s", to_str, True, None),
+    ("reading", "s1Value", to_float, True, None),
+    ("sensor_name", "s1Sensor", None, False, None),
+    ("reading_units", "s1Units", None, False, None),
+    ("unix_s", "unix_s", to_int, True, None),
+    ("lat", "la", to_float, False, None),
+    ("long", "lo", to_float, False, None),
+    ("signal_strength", "rsrp", None, False, None),
+    ("battery_voltage", "bv", None, False, None),
+    ("device_temp", "bt", None, False, None),
+    ("gps_acc", "ac", None, False, None),
+    ("gps_fix_time", "ti", None, False, None),
+    ("sd_size", "ss", None, False, None),
+    ("sd_util", "sf", None, False, None),
+    ("throttle", "th", None, False, None),
+    ("free_heap", "sh", None, False, None),
+    ("reset_uuid", "sr", None, False, None),
+]
+
+
+class rypar_uplink:
+
+    __slots__ = tuple(f[0] for f in RYPAR_UPLINK_SCHEMA)
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def to_dict(self):
+        return {name : getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "rypar_uplink(" + ", ".join(name + "=" + repr(getattr(self, name)) for name in self.__slots__) + ")"
+
+
+class payload_decoder:
+
+    def __init__(self, schema, record_class):
+
+        self.record_class = record_class
+
+        self._fields = tuple(
+            (name, key, coerce, required, default)
+            for name, key, coerce, required, default in schema
+        )
+        self._new_record = record_class.__new__
+
+        self.decode = self.compile()
+
+    ## Compile the schema into a straight-line function for well formed payloads
+    ## Anything unexpected (a missing key, a failed coercion, a required None)
+    ## drops to decode_checked, which collects every problem with the payload
+    def compile(self):
+
+        namespace = {
+            "new_record" : self._new_record,
+            "record_class" : self.record_class,
+            "decode_checked" : self.decode_checked,
+        }
+        lines = [
+            "def decode(payload):",
+            "    try:",
+            "        record = new_record(record_class)",
+        ]
+        required_names = []
+        for i, (name, key, coerce, required, default) in enumerate(self._fields):
+            if coerce is None:
+                lines.append("        record." + name + " = payload[" + repr(key) + "]")
+            else:
+                namespace["coerce_" + str(i)] = coerce
+                lines.append("        record." + name + " = coerce_" + str(i) + "(payload[" + repr(key) + "])")
+            if required:
+                required_names.append("record." + name + " is None")
+        lines.append("    except (KeyError, TypeError, ValueError):")
+        lines.append("        return decode_checked(payload)")
+        if len(required_names) > 0:
+            lines.append("    if " + " or ".join(required_names) + ":")
+            lines.append("        return decode_checked(payload)")
+        lines.append("    return record, []")
+
+        exec("\n".join(lines), namespace)
+        return namespace["decode"]
+
+    ## Returns (record, problems)
+    ## record is None if any required field is missing or invalid, and problems
+    ## lists every issue found with the payload (including optional fields that
+    ## fell back to their default)
+    def decode_checked(self, payload):
+
+        record = self._new_record(self.record_class)
+        problems = []
+        fatal = False
+
+        for name, key, coerce, required, default in self._fields:
+
+            value = payload.get(key, default)
+            if value is None:
+                if required:
+                    problems.append("missing required field '" + key + "'")
+                    fatal = True
+                elif key not in payload:
+                    problems.append("missing field '" + key + "' - using default " + repr(default))
+                setattr(record, name, default)
+                continue
+
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    if required:
+                        problems.append("invalid value for required field '" + key + "' : " + repr(value))
+                        fatal = True
+                    else:
+                        problems.append("invalid value for field '" + key + "' : " + repr(value) + " - using default " + repr(default))
+                    value = default
+
+            setattr(record, name, value)
+
+        if fatal:
+            return None, problems
+        return record, problems
+
+
+_uplink_decoder = payload_decoder(RYPAR_UPLINK_SCHEMA, rypar_uplink)
+
+
+def decode_uplink(payload):
+    return _uplink_decoder.decode(payload)
+
+
+## Tank level (%) for a whole series of raw height readings in one pass
+## Uses numpy when it is available, otherwise falls back to a plain list
+def recompute_levels(readings, tank_height, zero_cal):
+
+    if np is not None:
+        readings = np.asarray(readings, dtype=np.float64)
+        return ((readings - zero_cal) / tank_height) * 100
+
+    return [((r - zero_cal) / tank_height) * 100 for r in readings]
+
+
+DEFAULT_DEDUP_LRU_SIZE = 4096
+
+
+## The (device id, unix_s) a Rypar uplink payload is identified by, or None
+def get_dedup_key(msg_obj):
+
+    if not msg_obj or not isinstance(msg_obj.get('payload'), dict):
+        return None
+    payload = msg_obj['payload']
+    if payload.get('s') is None or payload.get('unix_s') is None:
+        return None
+    try:
+        return (str(payload['s']), int(payload['unix_s']))
+    except (TypeError, ValueError):
+        return None
+
+
+## Detects repeated (retransmitted or redelivered) and out of order uplinks
+## A bounded LRU remembers the readings processed recently, and a high water
+## mark per device holds the newest unix_s processed - anything at or below it
+## would overwrite the current state with an older reading
+## The high water marks are seeded from (and persisted to) a channel aggregate,
+## so they survive cold starts
+class uplink_dedup:
+
+    def __init__(self, max_entries=DEFAULT_DEDUP_LRU_SIZE):
+
+        self.max_entries = max_entries
+        self._seen = collections.OrderedDict()
+        self._high_water = {}
+        self._lock = threading.Lock()
+
+    def has_high_water(self, device_id):
+        with self._lock:
+            return device_id in self._high_water
+
+    ## unix_s may be None, recording that the device has no persisted mark yet
+    def set_high_water(self, device_id, unix_s):
+        with self._lock:
+            current = self._high_water.get(device_id)
+            if current is None or (unix_s is not None and unix_s > current):
+                self._high_water[device_id] = unix_s
+
+    def get_high_water(self, device_id):
+        with self._lock:
+            return self._high_water.get(device_id)
+
+    ## Returns None for a new reading, otherwise "duplicate" or "stale"
+    def check(self, device_id, unix_s):
+
+        with self._lock:
+            if (device_id, unix_s) in self._seen:
+                self._seen.move_to_end((device_id, unix_s))
+                return "duplicate"
+            high_water = self._high_water.get(device_id)
+            if high_water is not None and unix_s == high_water:
+                return "duplicate"
+            if high_water is not None and unix_s < high_water:
+                return "stale"
+        return None
+
+    def mark_processed(self, device_id, unix_s):
+
+        with self._lock:
+            self._seen[(device_id, unix_s)] = True
+            self._seen.move_to_end((device_id, unix_s))
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+        self.set_high_water(device_id, unix_s)
+
+
+_uplink_dedup = uplink_dedup()
+
+
+def get_uplink_dedup():
+    return _uplink_dedup
+
+
+## (name, window length (s), bucket length (s)) for the rolling level statistics
+LEVEL_STATS_WINDOWS = [
+    ("hour", 3600, 300),
+    ("day", 86400, 3600),
+    ("week", 7 * 86400, 86400),
+]
+
+## Fields of each bucket in the persisted state
+LEVEL_BUCKET_FIELDS = ("start", "count", "mean", "min", "max")
+
+## Decimal places kept for bucket means in the persisted state
+LEVEL_STATS_PRECISION = 4
+
+
+## Rolling min / max / mean and net fill (+) / drain (-) rate of one device's
+## readings over each of LEVEL_STATS_WINDOWS, without keeping the readings
+## Each window is a short list of fixed length buckets - a reading updates the
+## newest bucket in place (a running, Welford style mean alongside min / max),
+## and buckets that fall out of the window are dropped. The rate is taken
+## between the means of the oldest and newest buckets in the window
+## So both update() and summary() cost the same however long the device has run
+## Readings at or before the newest one seen are ignored
+class rolling_level_stats:
+
+    def __init__(self, windows=LEVEL_STATS_WINDOWS):
+
+        self.windows = windows
+        self.last_t = None
+        self.buckets = {name : [] for name, length, bucket_length in windows}
+
+    def update(self, unix_s, value):
+
+        if self.last_t is not None and unix_s <= self.last_t:
+            return False
+        self.last_t = unix_s
+
+        for name, length, bucket_length in self.windows:
+            buckets = self.buckets[name]
+            start = unix_s - (unix_s % bucket_length)
+
+            if len(buckets) > 0 and buckets[-1][0] == start:
+                b = buckets[-1]
+                b[1] += 1
+                b[2] += (value - b[2]) / b[1]
+                if value < b[3]:
+                    b[3] = value
+                if value > b[4]:
+                    b[4] = value
+            else:
+                buckets.append([start, 1, value, value, value])
+
+            while buckets[0][0] + bucket_length <= unix_s - length:
+                buckets.pop(0)
+
+        return True
+
+    ## {window name : {"min", "max", "mean", "rate"}} in reading units, with rate
+    ## per hour (None until the window spans two buckets)
+    def summary(self):
+
+        result = {}
+        for name, length, bucket_length in self.windows:
+            buckets = self.buckets[name]
+            if len(buckets) == 0:
+                result[name] = {"min" : None, "max" : None, "mean" : None, "rate" : None}
+                continue
+
+            count = 0
+            mean = 0.0
+            for b in buckets:
+                count += b[1]
+                mean += (b[2] - mean) * b[1] / count
+
+            rate = None
+            dt = buckets[-1][0] - buckets[0][0]
+            if dt > 0:
+                rate = (buckets[-1][2] - buckets[0][2]) / dt * 3600
+
+            result[name] = {
+                "min" : min(b[3] for b in buckets),
+                "max" : max(b[4] for b in buckets),
+                "mean" : mean,
+                "rate" : rate,
+            }
+
+        return result
+
+    def to_state(self):
+
+        buckets = {}
+        for name, window_buckets in self.buckets.items():
+            buckets[name] = [[b[0], b[1], round(b[2], LEVEL_STATS_PRECISION), b[3], b[4]] for b in window_buckets]
+        return {"last_t" : self.last_t, "buckets" : buckets}
+
+    @classmethod
+    def from_state(cls, state, windows=LEVEL_STATS_WINDOWS):
+
+        stats = cls(windows)
+        if not isinstance(state, dict):
+            return stats
+        stats.last_t = state.get("last_t")
+        buckets = state.get("buckets") or {}
+        for name, length, bucket_length in windows:
+            stats.buckets[name] = [list(b) for b in buckets.get(name, []) if len(b) == len(LEVEL_BUCKET_FIELDS)]
+        return stats
+
+
+## rolling_level_stats per device id, kept for the life of the process
+_level_stats = {}
+
+
+def get_level_stats(device_id):
+    return _level_stats.get(device_id)
+
+
+def set_level_stats(device_id, stats):
+    _level_stats[device_id] = stats
+
+
+## Time constant (s) of the consumption rate average - readings this far apart
+## carry about 63% of the weight of the new one
+DEFAULT_FORECAST_TAU = 86400
+
+## A rise in level between readings larger than this is a refill - in % points,
+## or the equivalent in whatever units the forecaster is fed
+DEFAULT_REFILL_THRESHOLD = 5.0
+
+## Readings further apart than this (s) say too little about the rate (there may
+## have been a refill in between) - the gap is skipped over rather than averaged
+DEFAULT_FORECAST_MAX_GAP = 2 * 86400
+
+## Consumption rates (level units per hour) below this are treated as not draining
+MIN_FORECAST_RATE = 0.001
+
+
+## Streaming estimate of a tank's consumption rate (level units per hour), for
+## forecasting when it will run empty or reach an alarm level
+## Levels can be in any units that rise with the level (% full, or the raw sensor
+## readings) as long as refill_threshold and the levels given to days_until are too
+## Each pair of consecutive readings gives a rate, which is folded into an
+## exponentially weighted average weighted by the time between them - so bursts
+## of closely spaced readings and long gaps are both weighted for the time they
+## cover, and sensor noise averages out. The average is bias corrected while it
+## warms up. A refill (a step up in level) or a long gap rebases on the new
+## level without counting towards the rate
+## Only the last reading and two running sums are kept
+class consumption_forecaster:
+
+    def __init__(self, tau=DEFAULT_FORECAST_TAU, refill_threshold=DEFAULT_REFILL_THRESHOLD, max_gap=DEFAULT_FORECAST_MAX_GAP):
+
+        self.tau = tau
+        self.refill_threshold = refill_threshold
+        self.max_gap = max_gap
+
+        self.last_t = None
+        self.last_level = None
+        self.average = 0.0
+        self.weight = 0.0
+
+    ## Returns False if the reading was ignored (at or before the last one)
+    def update(self, unix_s, level):
+
+        if self.last_t is not None and unix_s <= self.last_t:
+            return False
+
+        if (
+                self.last_t is not None
+                and level - self.last_level <= self.refill_threshold
+                and unix_s - self.last_t <= self.max_gap
+            ):
+            dt = unix_s - self.last_t
+            rate = (self.last_level - level) / dt * 3600
+            alpha = 1 - math.exp(-dt / self.tau)
+            self.average += alpha * (rate - self.average)
+            self.weight += alpha * (1 - self.weight)
+
+        self.last_t = unix_s
+        self.last_level = level
+        return True
+
+    ## Consumption in level units per hour, or None until there is a pair of readings
+    def get_rate(self):
+
+        if self.weight <= 0:
+            return None
+        return self.average / self.weight
+
+    ## Days until the level falls to `level`, 0 if it already has, or None if
+    ## the tank isn't draining
+    def days_until(self, level):
+
+        rate = self.get_rate()
+        if rate is None or self.last_level is None or rate < MIN_FORECAST_RATE:
+            return None
+        if self.last_level <= level:
+            return 0.0
+        return (self.last_level - level) / rate / 24
+
+    def to_state(self):
+        return {
+            "last_t" : self.last_t,
+            "last_level" : self.last_level,
+            "average" : self.average,
+            "weight" : self.weight,
+        }
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+
+        forecaster = cls(**kwargs)
+        if not isinstance(state, dict):
+            return forecaster
+        forecaster.last_t = state.get("last_t")
+        forecaster.last_level = state.get("last_level")
+        forecaster.average = state.get("average", 0.0)
+        forecaster.weight = state.get("weight", 0.0)
+        if forecaster.last_level is None:
+            forecaster.last_t = None
+        return forecaster
+
+
+## consumption_forecaster per device id, kept for the life of the process
+_forecasters = {}
+
+
+def get_forecaster(device_id):
+    return _forecasters.get(device_id)
+
+
+def set_forecaster(device_id, forecaster):
+    _forecasters[device_id] = forecaster
@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import os, sys, time, json, traceback, datetime
+import os, sys, time, json, traceback, datetime, asyncio, hashlib, tempfile
 
 
 ## This is the definition for a tiny lambda function
@@ -12,18 +12,119 @@ import os, sys, time, json, traceback, datetime
 ## You can import the pydoover module to interact with Doover based on decisions made in this function
 ## Just add the current directory to the path first
 
-## attempt to delete any loaded pydoover modules that persist across lambdas
+## pydoover is kept loaded across warm invocations of the same container, so its
+## pooled connections, cached aggregates and clients can be reused
+## Set DOOVER_FORCE_RELOAD=1 to reload it on every invocation instead (cold start)
 
-
-if 'pydoover' in sys.modules:
+if os.environ.get('DOOVER_FORCE_RELOAD') == '1' and 'pydoover' in sys.modules:
     del sys.modules['pydoover']
-try: del pydoover
-except: pass
-try: del pd
-except: pass
 
 # sys.path.append(os.path.dirname(__file__))
 import pydoover as pd
+import rypar
+
+
+## (setting name, ui_cmds key, default) for each setting read by uplink
+UPLINK_SETTINGS = [
+    ("tankHeight", "tankHeight", 230),
+    ("inputZeroCal", "inputZeroCal", 0),
+    ("minColor", "minColourState", "red"),
+    ("midColor", "midColourState", "yellow"),
+    ("maxColor", "maxColourState", "green"),
+    ("maxLevel", "maxLevel", 100),
+    ("maxMidLevel", "maxMidLevel", 70),
+    ("midMinLevel", "midMinLevel", 30),
+    ("minLevel", "minLevel", 0),
+]
+
+## (ui path, element attribute, value name, omit if None) for each value published
+## to ui_state by uplink - ui paths are the element names in the UI definition,
+## dotted through submodules. Value names are rypar_uplink attributes, or the
+## values derived in process_uplink
+UPLINK_UI_FIELDS = [
+    ("location", "currentValue", "position", True),
+    ("sensorReading", "currentValue", "perc_reading", False),
+    ("sensorReading", "ranges", "level_ranges", False),
+    ("daysUntilEmpty", "currentValue", "days_until_empty", False),
+    ("daysUntilLow", "currentValue", "days_until_low", False),
+    ("sensorLastRead", "currentValue", "last_reading", False),
+    ("battVoltage", "currentValue", "battery_voltage", False),
+    ("level_stats_submodule.levelMinHour", "currentValue", "level_min_hour", False),
+    ("level_stats_submodule.levelMaxHour", "currentValue", "level_max_hour", False),
+    ("level_stats_submodule.levelMeanHour", "currentValue", "level_mean_hour", False),
+    ("level_stats_submodule.levelRateHour", "currentValue", "level_rate_hour", False),
+    ("level_stats_submodule.levelMinDay", "currentValue", "level_min_day", False),
+    ("level_stats_submodule.levelMaxDay", "currentValue", "level_max_day", False),
+    ("level_stats_submodule.levelMeanDay", "currentValue", "level_mean_day", False),
+    ("level_stats_submodule.levelRateDay", "currentValue", "level_rate_day", False),
+    ("level_stats_submodule.levelMinWeek", "currentValue", "level_min_week", False),
+    ("level_stats_submodule.levelMaxWeek", "currentValue", "level_max_week", False),
+    ("level_stats_submodule.levelMeanWeek", "currentValue", "level_mean_week", False),
+    ("level_stats_submodule.levelRateWeek", "currentValue", "level_rate_week", False),
+    ("settings_submodule.gpsAccuracy", "currentValue", "gps_acc", False),
+    ("settings_submodule.sensor_settings_submodule.rawHeightReading", "currentValue", "reading", False),
+    ("settings_submodule.debug_submodule.deviceImei", "currentValue", "device_id", False),
+    ("settings_submodule.debug_submodule.sensorName", "currentValue", "sensor_name", False),
+    ("settings_submodule.debug_submodule.sensorUnits", "currentValue", "reading_units", False),
+    ("settings_submodule.debug_submodule.systemFreeHeap", "currentValue", "free_heap", False),
+    ("settings_submodule.debug_submodule.systemThrottled", "currentValue", "throttle", False),
+    ("settings_submodule.debug_submodule.sdCardSize", "currentValue", "sd_size", False),
+    ("settings_submodule.debug_submodule.sdUtilization", "currentValue", "sd_util", False),
+    ("settings_submodule.debug_submodule.gpsFixTime", "currentValue", "gps_fix_time", False),
+    ("settings_submodule.debug_submodule.systemResetUuid", "currentValue", "reset_uuid", False),
+    ("settings_submodule.debug_submodule.dataSignalStrength", "currentValue", "signal_strength", False),
+    ("settings_submodule.debug_submodule.deviceTemp", "currentValue", "device_temp", False),
+]
+
+## (ui path, element attribute, value) published unchanged with every uplink
+UPLINK_UI_STATIC = [
+    # ("sensorReading", "displayString", f"{sensor_name} ({reading_units})"),
+    ("sensorReading", "displayString", "Tank Level (%)"),
+]
+
+UPLINK_UI_STATE = pd.ui_state_template(UPLINK_UI_FIELDS, UPLINK_UI_STATIC)
+
+## (ui path, element attribute) sent with every ui_state publish, even when unchanged
+## - a deploy (possibly from another container) resets these to the UI definition's
+## defaults, which the state tracker can't see
+UI_STATE_ALWAYS_PUBLISHED = [
+    ("sensorReading", "ranges"),
+    ("sensorReading", "displayString"),
+]
+
+LEVEL_STATS_VALUE_NAMES = [f[2] for f in UPLINK_UI_FIELDS if f[0].startswith("level_stats_submodule.")]
+
+DEFAULT_SETTINGS_CACHE_TTL = 300
+
+## The key on the ui_state aggregate holding the hash of the deployed UI definition
+UI_HASH_KEY = "ui_hash"
+
+_ui_definition = None
+
+KWARGS_SUMMARY_MAX_CHARS = 500
+
+DEFAULT_BACKFILL_CHANNEL = "tank_level_backfill"
+DEFAULT_BACKFILL_CHUNK_SIZE = 5000
+
+## Channel the on_flush task listens on - an invocation that holds back a reading
+## for the debounce window asks for it to be flushed here, once the window is up
+DEFAULT_DEBOUNCE_FLUSH_CHANNEL = "debounce_flush_requests"
+
+## How many of the newest uplink channel messages a cold flush looks through for
+## the held reading (skipping e.g. the empty messages deploy publishes there)
+DEBOUNCE_FLUSH_SEARCH = 5
+
+## Where publishes that fail (or have to wait behind ones that did) are spooled
+DEFAULT_OUTBOX_DIR = os.path.join(tempfile.gettempdir(), "rypar_outbox")
+
+## Channel holding the newest unix_s processed per device, used to drop duplicate uplinks
+DEDUP_STATE_CHANNEL = "rypar_dedup_state"
+
+## Channel holding the rolling level statistics state per device
+LEVEL_STATS_CHANNEL = "rypar_level_stats"
+
+## Channel holding the consumption rate forecast state per device
+FORECAST_STATE_CHANNEL = "rypar_forecast_state"
 
 
 class target:
@@ -37,12 +138,22 @@ class target:
         #     'api_endpoint' : The API endpoint to interact with e.g. "https://my.doover.com",
         #     'package_config' : A dictionary object with configuration for the task - as stored in the task channel in Doover,
         #     'msg_obj' : A dictionary object of the msg that has invoked this task,
+        #     'msg_objs' : (optional) A list of msg objects for the same agent, to process as a single batch,
         #     'task_id' : The identifier string of the task channel used to run this processor,
         #     'log_channel' : The identifier string of the channel to publish any logs to
         #     'agent_settings' : {
         #       'deployment_config' : {} # a dictionary of the deployment config for this agent
         #     }
 
+        ## Devices whose level statistics / forecast state changed in this invocation,
+        ## and so need persisting (reset by load_level_stats / load_forecasters)
+        self._level_stats_updated = set()
+        self._forecasts_updated = set()
+
+        ## (channel name, request) asking for a held reading to be flushed, sent with
+        ## the state publishes (see request_debounce_flush)
+        self._debounce_flush_request = None
+
 
     ## This function is invoked after the singleton instance is created
     def execute(self):
@@ -50,10 +161,13 @@ class target:
         start_time = time.time()
 
         self.create_doover_client()
+        self.start_api_timing()
 
-        self.add_to_log( "kwargs = " + str(self.kwargs) )
+        self.add_to_log( "kwargs = " + str(self.get_kwargs_summary()) )
         self.add_to_log( str( start_time ) )
 
+        self.setup_outbox()
+
         try:
 
             ## Get the oem_uplink channel
@@ -92,12 +206,24 @@ class target:
                 self.downlink(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
 
             if message_type == "UPLINK":
-                self.uplink(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
+                if self.kwargs['package_config'].get('async_publish', False):
+                    self.create_async_doover_client()
+                    asyncio.run(self.uplink_async())
+                else:
+                    self.uplink(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
+
+            if message_type == "BACKFILL":
+                self.backfill(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
+
+            if message_type == "FLUSH":
+                self.flush_debounced(oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel)
 
         except Exception as e:
-            self.add_to_log("ERROR attempting to process message - " + str(e))
-            self.add_to_log(traceback.format_exc())
+            self.add_to_log("ERROR attempting to process message - " + str(e), level="ERROR")
+            self.add_to_log(traceback.format_exc(), level="ERROR")
 
+        self.check_outbox()
+        self.finish_api_timing()
         self.complete_log()
 
 
@@ -105,6 +231,66 @@ class target:
     def deploy(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
         ## Run any deployment code here
 
+        ui_obj, ui_msg_str, ui_hash = self.get_ui_definition()
+
+        ## Skip the (large) UI publish and the re-trigger of uplink processing if
+        ## this exact UI definition is already deployed to the agent
+        force_deploy = self.kwargs['package_config'].get('force_deploy', False)
+        if not force_deploy and self.get_deployed_ui_hash(ui_state_channel) == ui_hash:
+            self.add_to_log( "UI definition unchanged (" + ui_hash + ") - skipping deploy" )
+            return
+
+        ui_state_channel.publish(
+            msg_str=ui_msg_str,
+            idempotency_key=self.get_idempotency_key("ui_state")
+        )
+
+        ## The whole UI has been replaced, so the next uplink must publish its full state
+        pd.get_state_tracker().forget(self.kwargs['agent_id'])
+
+        ## Publish a dummy message to oem_uplink to trigger a new process of data
+        oem_uplink_channel.publish(
+            msg_str=pd.json_dumps({}),
+            save_log=False,
+            log_aggregate=False,
+            idempotency_key=self.get_idempotency_key("rypar_oem_uplink_recv")
+        )
+
+
+    ## The UI definition is built and serialized once per process, and stamped
+    ## with a hash of its content so redeploys of the same definition can be skipped
+    def get_ui_definition(self):
+        global _ui_definition
+
+        if _ui_definition is None:
+            ui_obj = self.build_ui_obj()
+            ## Hashed with the stdlib encoder so the hash doesn't depend on the JSON backend
+            ui_hash = hashlib.sha256(
+                json.dumps(ui_obj, sort_keys=True).encode()
+            ).hexdigest()
+            ui_obj[UI_HASH_KEY] = ui_hash
+            _ui_definition = (ui_obj, pd.json_dumps(ui_obj), ui_hash)
+
+        return _ui_definition
+
+
+    def get_deployed_ui_hash(self, ui_state_channel):
+
+        try:
+            aggregate = ui_state_channel.get_aggregate()
+        except Exception as e:
+            self.add_to_log("Error getting deployed ui_state - " + str(e), level="WARNING")
+            return None
+
+        ## A deployment resets ui_state to {"state" : null}, which would otherwise
+        ## leave the hash of the UI it replaced behind
+        if not isinstance(aggregate, dict) or not isinstance(aggregate.get("state"), dict):
+            return None
+        return aggregate.get(UI_HASH_KEY)
+
+
+    def build_ui_obj(self):
+
         ui_obj = {
             "state" : {
                 "type" : "uiContainer",
@@ -148,6 +334,20 @@ class target:
                             }
                         ]
                     },
+                    "daysUntilEmpty" : {
+                        "type" : "uiVariable",
+                        "varType" : "float",
+                        "name" : "daysUntilEmpty",
+                        "displayString" : "Days until empty",
+                        "decPrecision": 1,
+                    },
+                    "daysUntilLow" : {
+                        "type" : "uiVariable",
+                        "varType" : "float",
+                        "name" : "daysUntilLow",
+                        "displayString" : "Days until low level",
+                        "decPrecision": 1,
+                    },
                     "sensorLastRead": {
                         "type" : "uiVariable",
                         "varType" : "text",
@@ -191,6 +391,7 @@ class target:
                             }
                         ]
                     },
+                    "level_stats_submodule" : self.build_level_stats_submodule(),
                     "settings_submodule": {
                         "type": "uiSubmodule",
                         "name": "settings_submodule",
@@ -510,20 +711,45 @@ class target:
             }
         }
 
-        ui_state_channel.publish(
-            msg_str=json.dumps(ui_obj)
-        )
+        return ui_obj
 
-        ## Publish a dummy message to oem_uplink to trigger a new process of data
-        oem_uplink_channel.publish(
-            msg_str=json.dumps({}),
-            save_log=False,
-            log_aggregate=False
-        )
+
+    ## Min / max / mean level and fill rate for each rolling statistics window
+    def build_level_stats_submodule(self):
+
+        children = {}
+        for window, window_name in (("Hour", "last hour"), ("Day", "last day"), ("Week", "last week")):
+            for stat, stat_name in (("Min", "Min level"), ("Max", "Max level"), ("Mean", "Mean level")):
+                children["level" + stat + window] = {
+                    "type" : "uiVariable",
+                    "varType" : "float",
+                    "name" : "level" + stat + window,
+                    "displayString" : stat_name + ", " + window_name + " (%)",
+                    "decPrecision": 1,
+                }
+            children["levelRate" + window] = {
+                "type" : "uiVariable",
+                "varType" : "float",
+                "name" : "levelRate" + window,
+                "displayString" : "Fill rate, " + window_name + " (%/h)",
+                "decPrecision": 2,
+            }
+
+        return {
+            "type": "uiSubmodule",
+            "name": "level_stats_submodule",
+            "displayString": "Level Statistics",
+            "children": children,
+        }
 
 
     def downlink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
         ## Run any downlink processing code here
+
+        ## ui_cmds has changed - refresh the cached settings in this container
+        ## Other warm containers will pick the change up once their entry expires
+        ui_cmds_channel.invalidate_cached_aggregate()
+        ui_cmds_channel.refresh_aggregate(cache_ttl=self.get_settings_cache_ttl())
         return None
         # cmds_obj = ui_cmds_channel.get_aggregate()
 
@@ -607,239 +833,950 @@ class target:
 
     def uplink(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
         ## Run any uplink processing code here
-        cmds_obj = ui_cmds_channel.get_aggregate()
+        msg_objs = self.filter_duplicate_uplinks(self.get_uplink_msg_objs())
+        if len(msg_objs) == 0:
+            return
 
-        tankHeight = 230
-        try:
-            tankHeight = cmds_obj['cmds']['tankHeight']
-        except Exception as e:
-            self.add_to_log("Error getting tankHeight - " + str(e))
+        cmds_obj = ui_cmds_channel.get_aggregate(cache_ttl=self.get_settings_cache_ttl())
+        settings = self.get_uplink_settings(cmds_obj)
 
-        inputZeroCal = 0
-        try:
-            inputZeroCal = cmds_obj['cmds']['inputZeroCal']
-        except Exception as e:
-            self.add_to_log("Error getting inputZeroCal - " + str(e))
+        results, held = self.debounce_uplinks(self.process_uplinks(msg_objs, settings), settings)
 
-        minColor = "red"
-        try: 
-            minColor = cmds_obj['cmds']['minColourState']
-        except Exception as e:
-            self.add_to_log("Error getting minColor - " + str(e))
-        
-        midColor = "yellow"
-        try:
-            midColor = cmds_obj['cmds']['midColourState']
-        except Exception as e:
-            self.add_to_log("Error getting midColor - " + str(e))
+        self.publish_uplink_results(msg_objs, results, held, ui_state_channel, location_channel)
+
+
+    ## Publish the location / ui_state for each processed uplink along with the
+    ## processor state, in one call
+    def publish_uplink_results(self, msg_objs, results, held, ui_state_channel, location_channel):
+
+        publishes = []
+        for msg_obj, position, ui_state in results:
 
-        maxColor = "green"
+            if position is not None:
+                publishes.append(
+                    (location_channel, pd.json_dumps(position), self.get_idempotency_key("location", msg_obj))
+                )
+
+            patch = self.get_ui_state_delta(ui_state)
+            if patch is None:
+                self.add_to_log( "ui_state unchanged - skipping publish" )
+                continue
+
+            publishes.append(
+                (ui_state_channel, self.dumps_ui_state(patch, ui_state), self.get_idempotency_key("ui_state", msg_obj))
+            )
+            ## Tracked straight away, so the next reading in a batch is diffed against this one
+            self.mark_ui_state_published(patch)
+
+        for channel_name, state in self.get_state_publishes(msg_objs, results, held):
+            publishes.append(
+                (self.cli.get_channel(channel_name=channel_name, agent_id=self.kwargs['agent_id']), pd.json_dumps(state), self.get_idempotency_key(channel_name))
+            )
+
+        ## Commit all the outputs together - in one call with package_config['batch_publish']
+        ## on a server that has the batch publish endpoint
         try:
-            maxColor = cmds_obj['cmds']['maxColourState']
-        except Exception as e:
-            self.add_to_log("Error getting maxColor - " + str(e))
+            self.cli.publish_many(
+                publishes,
+                use_batch=self.use_batch_publish()
+            )
+        except Exception:
+            pd.get_state_tracker().forget(self.kwargs['agent_id'], "ui_state")
+            pd.get_publish_debouncer().forget( (self.kwargs['agent_id'], "ui_state") )
+            raise
 
-        maxLevel = 100
-        try: 
-            maxLevel = cmds_obj['cmds']['maxLevel']
-        except Exception as e:
-            self.add_to_log("Error getting maxLevel - " + str(e))
-        
-        maxMidLevel = 70
-        try: 
-            maxMidLevel = cmds_obj['cmds']['maxMidLevel']
-        except Exception as e:
-            self.add_to_log("Error getting maxMidLevel - " + str(e))
+        self.mark_uplinks_processed(msg_objs)
+
+
+    ## Publish the reading held back by the debounce window for this agent, once the
+    ## window has passed, rather than leaving it waiting on the next uplink
+    ## Run by the on_flush task for the request debounce_uplinks publishes when it
+    ## holds a reading (the request's flush_at is waited for first), and by long lived
+    ## runners (see fleet.py) once the window is up
+    ## A warm process publishes the reading it held - otherwise the held reading is
+    ## the newest uplink the dedup state hasn't seen published
+    def flush_debounced(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
+
+        window = self.get_debounce_window()
+        if window <= 0:
+            return
+
+        request = {}
+        msg_obj = self.kwargs.get('msg_obj')
+        if msg_obj is not None and isinstance(msg_obj.get('payload'), dict):
+            request = msg_obj['payload']
+        if request.get('flush_at') is not None:
+            delay = min(request['flush_at'] - time.time(), window)
+            if delay > 0:
+                time.sleep(delay)
+
+        self.load_debounce_state()
+        debouncer = pd.get_publish_debouncer()
+        key = (self.kwargs['agent_id'], "ui_state")
+        entry = debouncer.get_entry(key)
+        if entry is not None and time.time() - entry[0] < window:
+            ## Published since - anything held after that has its own flush coming
+            return
+
+        settings = self.get_uplink_settings(ui_cmds_channel.get_aggregate(cache_ttl=self.get_settings_cache_ttl()))
+
+        pending = debouncer.take_pending(key)
+        if pending is None:
+            msg_objs = self.filter_duplicate_uplinks(self.get_latest_uplink_msg_objs(oem_uplink_channel))
+            if len(msg_objs) == 0:
+                return
+            results = self.process_uplinks(msg_objs[:1], settings)
+            if len(results) == 0:
+                return
+            pending = results[-1]
+
+        debouncer.mark_published(key, flush_token=self.get_alarm_band(pending[2], settings))
+        self.add_to_log( "Publishing debounced uplink " + str(pending[0].get('message')) )
+
+        ## The statistics held back with the reading are persisted with it
+        self._level_stats_updated = set()
+        self._forecasts_updated = set()
+        dedup_key = rypar.get_dedup_key(pending[0])
+        if dedup_key is not None:
+            if rypar.get_level_stats(dedup_key[0]) is not None:
+                self._level_stats_updated.add(dedup_key[0])
+            if rypar.get_forecaster(dedup_key[0]) is not None:
+                self._forecasts_updated.add(dedup_key[0])
+
+        self.publish_uplink_results([pending[0]], [pending], False, ui_state_channel, location_channel)
+
+    ## The newest Rypar uplink on the uplink channel, as [msg_obj] (or [])
+    def get_latest_uplink_msg_objs(self, oem_uplink_channel):
+
+        messages = []
+        for message in oem_uplink_channel.iter_messages(page_size=DEBOUNCE_FLUSH_SEARCH):
+            messages.append(message)
+            if len(messages) >= DEBOUNCE_FLUSH_SEARCH:
+                break
+
+        for message, payload in zip(messages, oem_uplink_channel.fetch_payloads(messages)):
+            msg_obj = {
+                "message" : message.message_id,
+                "channel" : message.channel_id,
+                "payload" : payload,
+            }
+            if rypar.get_dedup_key(msg_obj) is not None:
+                return [msg_obj]
+        return []
+
+
+    async def uplink_async(self):
+        ## Same as uplink, but the location and ui_state publishes only depend on
+        ## the ui_cmds fetch - so fire them concurrently once that has returned
+        agent_id = self.kwargs['agent_id']
+        ui_state_channel = self.async_cli.get_channel(channel_name="ui_state", agent_id=agent_id)
+        ui_cmds_channel = self.async_cli.get_channel(channel_name="ui_cmds", agent_id=agent_id)
+        location_channel = self.async_cli.get_channel(channel_name="location", agent_id=agent_id)
+
+        msg_objs = self.filter_duplicate_uplinks(self.get_uplink_msg_objs())
+        if len(msg_objs) == 0:
+            return
+
+        cmds_obj = await ui_cmds_channel.get_aggregate(cache_ttl=self.get_settings_cache_ttl())
+        settings = self.get_uplink_settings(cmds_obj)
+
+        results, held = self.debounce_uplinks(self.process_uplinks(msg_objs, settings), settings)
+
+        state_publishes = self.get_state_publishes(msg_objs, results, held)
+        for msg_obj, position, ui_state in results:
+
+            publishes = []
+            patch = self.get_ui_state_delta(ui_state)
+            if patch is None:
+                self.add_to_log( "ui_state unchanged - skipping publish" )
+            else:
+                publishes.append(
+                    ui_state_channel.publish(
+                        msg_str=self.dumps_ui_state(patch, ui_state),
+                        save_log=True,
+                        idempotency_key=self.get_idempotency_key("ui_state", msg_obj)
+                    )
+                )
+            if position is not None:
+                publishes.append(
+                    location_channel.publish(
+                        msg_str=pd.json_dumps(position),
+                        save_log=True,
+                        idempotency_key=self.get_idempotency_key("location", msg_obj)
+                    )
+                )
+
+            for channel_name, state in state_publishes:
+                publishes.append(
+                    self.async_cli.get_channel(channel_name=channel_name, agent_id=agent_id).publish(
+                        msg_str=pd.json_dumps(state),
+                        idempotency_key=self.get_idempotency_key(channel_name)
+                    )
+                )
+            state_publishes = []
+
+            await asyncio.gather(*publishes)
+            if patch is not None:
+                self.mark_ui_state_published(patch)
+
+        ## Everything was held back - the state (with the held reading) still has to go
+        if len(state_publishes) > 0:
+            await asyncio.gather(*[
+                self.async_cli.get_channel(channel_name=channel_name, agent_id=agent_id).publish(
+                    msg_str=pd.json_dumps(state),
+                    idempotency_key=self.get_idempotency_key(channel_name)
+                )
+                for channel_name, state in state_publishes
+            ])
+
+        self.mark_uplinks_processed(msg_objs)
+
+
+    ## The (channel name, state) updates to publish alongside the outputs, so the
+    ## processor state survives a cold start - readings held back by the debounce
+    ## window aren't persisted until they are published (see flush_debounced)
+    def get_state_publishes(self, msg_objs, results, held):
+
+        publishes = []
+
+        dedup_state = self.get_dedup_state([r[0] for r in results] if held else msg_objs)
+        debounce_state = self.get_debounce_state()
+        if debounce_state is not None and len(results) > 0:
+            dedup_state = dict(dedup_state or {}, debounce=debounce_state)
+        if dedup_state is not None:
+            publishes.append( (DEDUP_STATE_CHANNEL, dedup_state) )
+
+        flush_request = self._debounce_flush_request
+        if flush_request is not None:
+            publishes.append( flush_request )
+            self._debounce_flush_request = None
+
+        level_stats_state = self.get_level_stats_state()
+        if level_stats_state is not None and len(results) > 0:
+            publishes.append( (LEVEL_STATS_CHANNEL, level_stats_state) )
+
+        forecast_state = self.get_forecast_state()
+        if forecast_state is not None and len(results) > 0:
+            publishes.append( (FORECAST_STATE_CHANNEL, forecast_state) )
+
+        return publishes
+
+
+    ## Drop uplinks that have already been processed (retransmits / redelivery) or
+    ## that are older than the newest reading processed for the device, before
+    ## anything is fetched or published - disable with package_config['dedup'] = False
+    def filter_duplicate_uplinks(self, msg_objs):
+
+        if not self.kwargs['package_config'].get('dedup', True):
+            return msg_objs
+
+        dedup = rypar.get_uplink_dedup()
+        keys = [rypar.get_dedup_key(msg_obj) for msg_obj in msg_objs]
+
+        ## Cold container - seed the high water marks from the persisted state
+        missing = set(k[0] for k in keys if k is not None and not dedup.has_high_water(k[0]))
+        if len(missing) > 0:
+            self.load_dedup_state(missing)
+
+        result = []
+        seen = set()
+        for msg_obj, key in zip(msg_objs, keys):
+            if key is None:
+                result.append(msg_obj)
+                continue
+            status = dedup.check(*key)
+            if status is None and key in seen:
+                status = "duplicate"
+            if status is not None:
+                self.add_to_log( "Skipping " + status + " uplink " + str(msg_obj.get('message')) + " (device " + key[0] + ", unix_s " + str(key[1]) + ")" )
+                continue
+            seen.add(key)
+            result.append(msg_obj)
+
+        return result
+
+    def load_dedup_state(self, device_ids):
+
+        dedup = rypar.get_uplink_dedup()
+        aggregate = self.get_persisted_state(DEDUP_STATE_CHANNEL, "dedup state")
+        devices = aggregate.get('devices')
+        if not isinstance(devices, dict):
+            devices = {}
+        for device_id in device_ids:
+            dedup.set_high_water(device_id, devices.get(device_id))
+
+        ## The debounce state is kept alongside, so it comes with the same fetch
+        self.load_debounce_state(aggregate)
+
+    ## The aggregate of a processor state channel - empty if there isn't one yet,
+    ## or it can't be fetched
+    def get_persisted_state(self, channel_name, description):
 
-        midMinLevel = 30
         try:
-            midMinLevel = cmds_obj['cmds']['midMinLevel']
+            state_channel = self.cli.get_channel(channel_name=channel_name, agent_id=self.kwargs['agent_id'])
+            aggregate = state_channel.get_aggregate()
+            if isinstance(aggregate, dict):
+                return aggregate
         except Exception as e:
-            self.add_to_log("Error getting midMinLevel - " + str(e))
+            self.add_to_log("Error getting " + description + " - " + str(e), level="WARNING")
+        return {}
+
+    ## The {device_id : state} persisted to a processor state channel
+    def get_persisted_device_states(self, channel_name, description):
+
+        devices = self.get_persisted_state(channel_name, description).get('devices')
+        if isinstance(devices, dict):
+            return devices
+        return {}
+
+    ## The high water mark update to persist for the uplinks being processed
+    def get_dedup_state(self, msg_objs):
+
+        if not self.kwargs['package_config'].get('dedup', True):
+            return None
+
+        devices = {}
+        for msg_obj in msg_objs:
+            key = rypar.get_dedup_key(msg_obj)
+            if key is not None and key[1] > devices.get(key[0], key[1] - 1):
+                devices[key[0]] = key[1]
+
+        if len(devices) == 0:
+            return None
+        return {"devices" : devices}
+
+    def mark_uplinks_processed(self, msg_objs):
+
+        if not self.kwargs['package_config'].get('dedup', True):
+            return
+
+        dedup = rypar.get_uplink_dedup()
+        for msg_obj in msg_objs:
+            key = rypar.get_dedup_key(msg_obj)
+            if key is not None:
+                dedup.mark_processed(*key)
+
+
+    ## How long (seconds) ui_state / location publishes for the agent are coalesced
+    ## over - 0 (the default) publishes every reading
+    def get_debounce_window(self):
+        return self.kwargs['package_config'].get('debounce_window', 0)
+
+    ## Which side of the alarm thresholds the tank level in ui_state is on
+    def get_alarm_band(self, ui_state, settings):
 
-        minLevel = 0
         try:
-            minLevel = cmds_obj['cmds']['minLevel']
-        except Exception as e:
-            self.add_to_log("Error getting minLevel - " + str(e))
-        
+            level = ui_state['state']['children']['sensorReading']['currentValue']
+            if level < settings['minLevel']:
+                return "min"
+            if level < settings['midMinLevel']:
+                return "low"
+        except (KeyError, TypeError):
+            return None
+        return "ok"
+
+    ## Hold back readings that arrive within the debounce window of the last publish
+    ## The newest held reading replaces any older one, and is published with (or
+    ## superseded by) the next reading after the window - a reading that crosses
+    ## the minLevel / midMinLevel thresholds is published immediately
+    ## Returns (results to publish, whether anything was held back)
+    def debounce_uplinks(self, results, settings):
+
+        window = self.get_debounce_window()
+        if window <= 0:
+            return results, False
+
+        self.load_debounce_state()
+        debouncer = pd.get_publish_debouncer()
+        key = (self.kwargs['agent_id'], "ui_state")
+
+        pending = debouncer.take_pending(key)
+        if pending is not None:
+            results = [pending] + results
+            if not self.kwargs['package_config'].get('publish_history', False):
+                results = results[-1:]
+
+        publish = []
+        held = None
+        for result in results:
+            band = self.get_alarm_band(result[2], settings)
+            if debouncer.should_publish(key, window, flush_token=band):
+                debouncer.mark_published(key, flush_token=band)
+                publish.append(result)
+                held = None
+            else:
+                held = result
+
+        if held is not None:
+            debouncer.hold(key, held)
+            self.add_to_log( "Uplink " + str(held[0].get('message')) + " held for debounce window of " + str(window) + "s" )
+            ## The first reading held in this window asks for the flush - later ones
+            ## replace it and go out with that same flush
+            if pending is None or len(publish) > 0:
+                self.request_debounce_flush(debouncer.get_entry(key)[0] + window)
+
+        return publish, held is not None
+
+    ## Queue a request for the on_flush task to publish the held reading at flush_at,
+    ## sent with the state publishes - package_config['debounce_flush_channel'] = None
+    ## leaves flushing to the runner (see fleet.py)
+    def request_debounce_flush(self, flush_at):
+
+        channel_name = self.kwargs['package_config'].get('debounce_flush_channel', DEFAULT_DEBOUNCE_FLUSH_CHANNEL)
+        if channel_name is None:
+            return
+        self._debounce_flush_request = (channel_name, {"flush_at" : flush_at})
 
-        if 'msg_obj' in self.kwargs and self.kwargs['msg_obj'] is not None:
-            msg_id = self.kwargs['msg_obj']['message']
-            channel_id = self.kwargs['msg_obj']['channel']
-            payload = self.kwargs['msg_obj']['payload']
+    ## Cold container - carry on from when the agent's ui_state was last published,
+    ## as persisted with the dedup state, so the window holds across containers
+    ## aggregate is the dedup state channel's, if it has already been fetched
+    def load_debounce_state(self, aggregate=None):
 
-        if not msg_id:
-            self.add_to_log( "No trigger message passed - skipping processing" )
+        if self.get_debounce_window() <= 0:
             return
-        
-        device_id = payload['s']
-        reading = payload['s1Value']
-        sensor_name = payload['s1Sensor']
-        reading_units = payload['s1Units']
-        last_reading = payload['unix_s']
-
-        last_reading = datetime.datetime.fromtimestamp(last_reading, datetime.timezone(datetime.timedelta(hours=10)))
-        last_reading = last_reading.strftime("%Y-%m-%d %I:%M %p")
-
-        device_lat = payload['la']
-        device_long = payload['lo']
-
-        signal_strength = payload['rsrp']
-        battery_voltage = payload['bv']
-        device_temp = payload['bt']
-        gps_acc = payload['ac']
-        gps_fix_time = payload['ti']
-        sd_size = payload['ss']
-        sd_util = payload['sf']
-        throttle = payload['th']
-        free_heap = payload['sh']
-        reset_uuid = payload['sr']
-
-        perc_reading  = ((reading-inputZeroCal) / tankHeight) * 100
-
-
-        position = {
-            'lat': float(device_lat),
-            'long': float(device_long),
-            # 'alt':210
+        debouncer = pd.get_publish_debouncer()
+        key = (self.kwargs['agent_id'], "ui_state")
+        if debouncer.get_entry(key) is not None:
+            return
+
+        if aggregate is None:
+            aggregate = self.get_persisted_state(DEDUP_STATE_CHANNEL, "debounce state")
+        state = aggregate.get('debounce')
+        if not isinstance(state, dict):
+            state = {}
+
+        ## An entry even if nothing was persisted, so it's only fetched once
+        debouncer.set_entry(key, state.get('published_at') or 0, state.get('flush_token'))
+
+    ## The debounce state to persist with a publish, or None if it isn't debounced
+    ## The held reading itself isn't persisted - it is already on the uplink channel
+    def get_debounce_state(self):
+
+        if self.get_debounce_window() <= 0:
+            return None
+        entry = pd.get_publish_debouncer().get_entry( (self.kwargs['agent_id'], "ui_state") )
+        if entry is None:
+            return None
+
+        published_at, flush_token, pending = entry
+        return {
+            "published_at" : published_at,
+            "flush_token" : flush_token,
         }
 
-        # position = {
-        #     'lat': f['Lat'],
-        #     'long': f['Long'],
-        #     'alt': f['Alt'],
-        # }
 
-        self.add_to_log( "Received uplink message - " + str(msg_id) )
+    ## Only publish the parts of the ui_state patch that changed since this process
+    ## last published one for the agent (plus UI_STATE_ALWAYS_PUBLISHED) - returns
+    ## None if nothing changed
+    ## Disable with package_config['delta_publish'] = False
+    def get_ui_state_delta(self, ui_state):
 
-        
+        if not self.kwargs['package_config'].get('delta_publish', True):
+            return ui_state
+
+        delta = pd.get_state_tracker().get_delta(self.kwargs['agent_id'], "ui_state", ui_state)
+        if delta is None or delta is ui_state:
+            return delta
+
+        for ui_path, attribute in UI_STATE_ALWAYS_PUBLISHED:
+            parts = ui_path.split(".")
+            node = ui_state.get('state')
+            for part in parts:
+                node = node.get('children', {}).get(part) if isinstance(node, dict) else None
+            if isinstance(node, dict) and attribute in node:
+                delta.setdefault('state', {})
+                pd.ui_state_template.set_path(delta, parts, attribute, node[attribute])
+        return delta
+
+    def mark_ui_state_published(self, ui_state):
+        pd.get_state_tracker().mark_published(self.kwargs['agent_id'], "ui_state", ui_state)
+
+
+    ## An invocation can carry a single uplink in 'msg_obj', or a backlog of
+    ## uplinks for the same agent in 'msg_objs' (e.g. after a coverage gap)
+    def get_uplink_msg_objs(self):
+
+        if self.kwargs.get('msg_objs'):
+            return list(self.kwargs['msg_objs'])
+
+        return [self.kwargs.get('msg_obj')]
+
+
+    ## Decode every uplink in the invocation, oldest first, into (msg_obj, position, ui_state)
+    ## By default only the newest reading is returned for publishing, unless
+    ## package_config['publish_history'] is set, in which case every reading is
+    def process_uplinks(self, msg_objs, settings):
+
+        ## Oldest first, so the rolling statistics see readings in order
+        msg_objs = sorted(msg_objs, key=self.get_uplink_unix_s)
+        self.load_level_stats(msg_objs)
+        self.load_forecasters(msg_objs)
+
+        results = []
+        for msg_obj in msg_objs:
+            try:
+                result = self.process_uplink(msg_obj, settings)
+            except Exception as e:
+                if len(msg_objs) == 1:
+                    raise
+                self.add_to_log("Error processing uplink message - " + str(e), level="ERROR")
+                continue
+
+            if result is not None:
+                results.append( (msg_obj,) + result )
+
+        if len(msg_objs) > 1:
+            self.add_to_log( "Processed " + str(len(results)) + " of " + str(len(msg_objs)) + " uplink messages" )
+
+        if not self.kwargs['package_config'].get('publish_history', False):
+            results = results[-1:]
+
+        return results
+
+
+    def get_uplink_unix_s(self, msg_obj):
+
+        key = rypar.get_dedup_key(msg_obj)
+        if key is None:
+            return 0
+        return key[1]
+
+
+    ## Rolling tank level statistics per device (see rypar.rolling_level_stats),
+    ## kept in the process and persisted to LEVEL_STATS_CHANNEL - disable with
+    ## package_config['level_stats'] = False
+    def level_stats_enabled(self):
+        return self.kwargs['package_config'].get('level_stats', True)
+
+    ## Cold container - load the persisted statistics for any devices not seen yet
+    def load_level_stats(self, msg_objs):
+
+        self._level_stats_updated = set()
+        if not self.level_stats_enabled():
+            return
+
+        keys = [rypar.get_dedup_key(msg_obj) for msg_obj in msg_objs]
+        missing = set(k[0] for k in keys if k is not None and rypar.get_level_stats(k[0]) is None)
+        if len(missing) == 0:
+            return
+
+        devices = self.get_persisted_device_states(LEVEL_STATS_CHANNEL, "level statistics")
+        for device_id in missing:
+            rypar.set_level_stats(device_id, rypar.rolling_level_stats.from_state(devices.get(device_id)))
+
+    ## Add the uplink to its device's statistics, and return the ui values for them
+    ## Levels are kept as raw readings, so they follow changes to the calibration
+    def update_level_stats(self, uplink, settings):
+
+        values = {name : None for name in LEVEL_STATS_VALUE_NAMES}
+        if not self.level_stats_enabled():
+            return values
+
+        stats = rypar.get_level_stats(uplink.device_id)
+        if stats is None:
+            stats = rypar.rolling_level_stats()
+            rypar.set_level_stats(uplink.device_id, stats)
+        if stats.update(uplink.unix_s, uplink.reading):
+            self._level_stats_updated.add(uplink.device_id)
+
+        scale = 100 / settings['tankHeight']
+        for window, summary in stats.summary().items():
+            for stat in ("min", "max", "mean"):
+                if summary[stat] is not None:
+                    values["level_" + stat + "_" + window] = (summary[stat] - settings['inputZeroCal']) * scale
+            if summary["rate"] is not None:
+                values["level_rate_" + window] = summary["rate"] * scale
+
+        return values
+
+    def get_level_stats_state(self):
+
+        updated = self._level_stats_updated
+        if not self.level_stats_enabled() or not updated:
+            return None
+        return {"devices" : {device_id : rypar.get_level_stats(device_id).to_state() for device_id in updated}}
+
+
+    ## Time to empty / low alarm forecasts per device (see rypar.consumption_forecaster),
+    ## kept in the process and persisted to FORECAST_STATE_CHANNEL - disable with
+    ## package_config['forecast'] = False
+    def forecast_enabled(self):
+        return self.kwargs['package_config'].get('forecast', True)
+
+    def load_forecasters(self, msg_objs):
+
+        self._forecasts_updated = set()
+        if not self.forecast_enabled():
+            return
+
+        keys = [rypar.get_dedup_key(msg_obj) for msg_obj in msg_objs]
+        missing = set(k[0] for k in keys if k is not None and rypar.get_forecaster(k[0]) is None)
+        if len(missing) == 0:
+            return
+
+        devices = self.get_persisted_device_states(FORECAST_STATE_CHANNEL, "forecast state")
+        for device_id in missing:
+            rypar.set_forecaster(device_id, rypar.consumption_forecaster.from_state(devices.get(device_id)))
+
+    ## Add the uplink's level to its device's consumption rate, and return the ui
+    ## values for the days until empty / until the low alarm (midMinLevel)
+    ## Levels are kept as raw readings, as for the level statistics, so a change to
+    ## the calibration doesn't look like a refill or a sudden drain - the % settings
+    ## are converted to raw readings with the current calibration instead
+    def update_forecast(self, uplink, settings):
+
+        values = {"days_until_empty" : None, "days_until_low" : None}
+        if not self.forecast_enabled():
+            return values
+
+        forecaster = rypar.get_forecaster(uplink.device_id)
+        if forecaster is None:
+            forecaster = rypar.consumption_forecaster()
+            rypar.set_forecaster(uplink.device_id, forecaster)
+        forecaster.refill_threshold = rypar.DEFAULT_REFILL_THRESHOLD / 100 * settings['tankHeight']
+        if forecaster.update(uplink.unix_s, uplink.reading):
+            self._forecasts_updated.add(uplink.device_id)
+
+        values["days_until_empty"] = forecaster.days_until(self.level_to_reading(0, settings))
+        values["days_until_low"] = forecaster.days_until(self.level_to_reading(settings['midMinLevel'], settings))
+        return values
+
+    ## The raw reading for a tank level (%), with the current calibration
+    def level_to_reading(self, level, settings):
+        return settings['inputZeroCal'] + level / 100 * settings['tankHeight']
+
+    def get_forecast_state(self):
+
+        updated = self._forecasts_updated
+        if not self.forecast_enabled() or not updated:
+            return None
+        return {"devices" : {device_id : rypar.get_forecaster(device_id).to_state() for device_id in updated}}
+
+
+    ## How long (seconds) the ui_cmds settings may be served from the process cache
+    def get_settings_cache_ttl(self):
+        return self.kwargs['package_config'].get('settings_cache_ttl', DEFAULT_SETTINGS_CACHE_TTL)
+
+
+    def get_uplink_settings(self, cmds_obj):
+
+        settings = {}
+        for name, cmd_key, default in UPLINK_SETTINGS:
+            value = default
+            try:
+                value = cmds_obj['cmds'][cmd_key]
+            except Exception as e:
+                self.add_to_log("Error getting " + name + " - " + str(e), level="WARNING")
+            settings[name] = value
+
+        return settings
+
+
+    ## Decode a single uplink msg_obj into the (position, ui_state) to publish
+    ## Returns None if there is nothing to publish
+    def process_uplink(self, msg_obj, settings):
+
+        msg_id = None
+        if msg_obj is not None:
+            msg_id = msg_obj['message']
+            channel_id = msg_obj['channel']
+            payload = msg_obj['payload']
+
+        if not msg_id:
+            self.add_to_log( "No trigger message passed - skipping processing" )
+            return None
 
         if not bool(payload):
             self.add_to_log( "No payload in message - skipping processing" )
-            return
-        
-        if position is not None:
-                location_channel.publish(
-                    msg_str=json.dumps(position),
-                    save_log=True
-                )
+            return None
+
+        uplink, problems = rypar.decode_uplink(payload)
+        for problem in problems:
+            self.add_to_log( "Uplink " + str(msg_id) + " - " + problem, level="WARNING" )
+        if uplink is None:
+            raise Exception("Invalid uplink payload in message " + str(msg_id) + " : " + "; ".join(problems))
+
+        values = uplink.to_dict()
+
+        last_reading = datetime.datetime.fromtimestamp(uplink.unix_s, datetime.timezone(datetime.timedelta(hours=10)))
+        values['last_reading'] = last_reading.strftime("%Y-%m-%d %I:%M %p")
+        values['perc_reading'] = ((uplink.reading - settings['inputZeroCal']) / settings['tankHeight']) * 100
+        values['level_ranges'] = self.get_level_ranges(settings)
+        values.update(self.update_level_stats(uplink, settings))
+        values.update(self.update_forecast(uplink, settings))
+
+        position = None
+        if uplink.lat is not None and uplink.long is not None:
+            position = {
+                'lat': uplink.lat,
+                'long': uplink.long,
+                # 'alt':210
+            }
+        values['position'] = position
 
-        ui_state_channel.publish(
-            msg_str=json.dumps({
-                "state" : {
-                    # "displayString" : "testing",
-                    # "statusIcon" : "idle",
-                    "children" : {
-                        "location" : {
-                            "currentValue" : position,
-                        },
-                        "sensorReading" : {
-                            # "displayString" : f"{sensor_name} ({reading_units})",
-                            "displayString" : "Tank Level (%)",
-                            "currentValue" : perc_reading,
-                            "ranges": [
-                                {
-                                    "label" : "Low",
-                                    "min" : minLevel,
-                                    "max" : midMinLevel,
-                                    "colour" : minColor,
-                                    "showOnGraph" : True
-                                },
-                                {
-                                    # "label" : "Ok",
-                                    "min" : midMinLevel,
-                                    "max" : maxMidLevel,
-                                    "colour" : midColor,
-                                    "showOnGraph" : True
-                                },
-                                {
-                                    "label" : "Fast",
-                                    "min" : maxMidLevel,
-                                    "max" : maxLevel,
-                                    "colour" : maxColor,
-                                    "showOnGraph" : True
-                                }
-                            ]
-                        },
-                        "sensorLastRead": {
-                            "currentValue" : last_reading,
-                        },
-                        "battVoltage": {
-                            "currentValue" : battery_voltage,
-                        },
-                        "settings_submodule": {
-                            "children": {
-                                "gpsAccuracy" : {
-                                    "currentValue" : gps_acc,
-                                },
-                                "sensor_settings_submodule":{
-                                    "children":{
-                                        "rawHeightReading" : {
-                                            "currentValue" : reading,
-                                        }
-                                    }
-                                },
-                                "debug_submodule" : {
-                                    "children":{
-                                        "deviceImei" : {
-                                            "currentValue" : device_id,
-                                        },
-                                        "sensorName" : {
-                                            "currentValue" : sensor_name,
-                                        },
-                                        "sensorUnits" : {
-                                            "currentValue" : reading_units,
-                                        },
-                                        "systemFreeHeap" : {
-                                            "currentValue" : free_heap,
-                                        },
-                                        "systemThrottled" : {
-                                            "currentValue" : throttle,
-                                        },
-                                        "sdCardSize" : {
-                                            "currentValue" : sd_size,
-                                        },
-                                        "sdUtilization" : {
-                                            "currentValue" : sd_util,
-                                        },
-                                        "gpsFixTime" : {
-                                            "currentValue" : gps_fix_time,
-                                        },
-                                        "systemResetUuid" : {
-                                            "currentValue" : reset_uuid,
-                                        },
-                                        "dataSignalStrength" : {
-                                            "currentValue" : signal_strength,
-                                        },
-                                        "deviceTemp" : {
-                                            "currentValue" : device_temp,
-                                        },
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
+        self.add_to_log( "Received uplink message - " + str(msg_id) )
+
+        ui_state = UPLINK_UI_STATE.build(values)
+
+        return position, ui_state
+
+
+    ## The coloured level bands shown on the sensorReading gauge
+    def get_level_ranges(self, settings):
+
+        return [
+            {
+                "label" : "Low",
+                "min" : settings['minLevel'],
+                "max" : settings['midMinLevel'],
+                "colour" : settings['minColor'],
+                "showOnGraph" : True
+            },
+            {
+                # "label" : "Ok",
+                "min" : settings['midMinLevel'],
+                "max" : settings['maxMidLevel'],
+                "colour" : settings['midColor'],
+                "showOnGraph" : True
+            },
+            {
+                "label" : "Fast",
+                "min" : settings['maxMidLevel'],
+                "max" : settings['maxLevel'],
+                "colour" : settings['maxColor'],
+                "showOnGraph" : True
+            }
+        ]
+
+
+    ## Serialize a ui_state patch for publishing - full patches built by
+    ## UPLINK_UI_STATE only need their values encoded
+    def dumps_ui_state(self, patch, ui_state):
+
+        if patch is ui_state:
+            return UPLINK_UI_STATE.dumps_patch(patch)
+        return pd.json_dumps(patch)
+
+    ## Recompute the tank level history with the current calibration settings
+    ## (e.g. after tankHeight or inputZeroCal has been corrected in ui_cmds)
+    ## The uplink history is streamed a chunk at a time, so memory is bounded by the
+    ## chunk size rather than by how long the device has been running
+    ## The triggering message payload may hold 'since' / 'until' to limit the range
+    def backfill(self, oem_uplink_channel, ui_state_channel, ui_cmds_channel, location_channel):
+
+        settings = self.get_uplink_settings(ui_cmds_channel.get_aggregate())
+
+        backfill_channel = self.cli.get_channel(
+            channel_name=self.kwargs['package_config'].get('backfill_channel', DEFAULT_BACKFILL_CHANNEL),
+            agent_id=self.kwargs['agent_id']
+        )
+        chunk_size = self.kwargs['package_config'].get('backfill_chunk_size', DEFAULT_BACKFILL_CHUNK_SIZE)
+
+        request = {}
+        msg_obj = self.kwargs.get('msg_obj')
+        if msg_obj is not None and isinstance(msg_obj.get('payload'), dict):
+            request = msg_obj['payload']
+
+        total = 0
+        fetched = 0
+        chunk = []
+        for message in oem_uplink_channel.iter_messages(since=request.get('since'), until=request.get('until'), page_size=chunk_size):
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                fetched += sum(1 for m in chunk if m.json_result is None)
+                total += self.backfill_chunk(oem_uplink_channel, backfill_channel, chunk, settings)
+                chunk = []
+
+        if len(chunk) > 0:
+            fetched += sum(1 for m in chunk if m.json_result is None)
+            total += self.backfill_chunk(oem_uplink_channel, backfill_channel, chunk, settings)
+
+        self.add_to_log( "Backfilled " + str(total) + " tank level readings" )
+        if fetched > 0:
+            self.add_to_log( "The message listing didn't include payloads - fetched " + str(fetched) + " of them with a request each", level="WARNING" )
+
+
+    ## Payloads are read from the message listing where the API includes them, and
+    ## only fetched (a request per message, over the pooled session) where it doesn't
+    def backfill_chunk(self, oem_uplink_channel, backfill_channel, chunk, settings):
+
+        unix_s = []
+        readings = []
+        for payload in oem_uplink_channel.fetch_payloads(chunk):
+            if not payload:
+                continue
+            uplink, problems = rypar.decode_uplink(payload)
+            if uplink is None:
+                continue
+            unix_s.append(uplink.unix_s)
+            readings.append(uplink.reading)
+
+        if len(readings) == 0:
+            return 0
+
+        levels = rypar.recompute_levels(readings, settings['tankHeight'], settings['inputZeroCal'])
+        if rypar.np is not None:
+            order = rypar.np.argsort(unix_s, kind="stable")
+            unix_s = rypar.np.asarray(unix_s)[order].tolist()
+            levels = levels[order].tolist()
+        else:
+            order = sorted(range(len(unix_s)), key=unix_s.__getitem__)
+            unix_s = [unix_s[i] for i in order]
+            levels = [levels[i] for i in order]
+
+        backfill_channel.publish(
+            msg_str=pd.json_dumps({
+                "tankHeight" : settings['tankHeight'],
+                "inputZeroCal" : settings['inputZeroCal'],
+                "unix_s" : unix_s,
+                "sensorReading" : levels,
             }),
-            save_log=True
+            save_log=True,
+            idempotency_key=self.get_idempotency_key(backfill_channel.channel_name, suffix=str(unix_s[0]))
         )
 
+        return len(levels)
+
+
+    ## A key for a publish made while handling msg_obj (the triggering message by
+    ## default), so that pydoover can safely retry it without publishing it twice
+    def get_idempotency_key(self, channel_name, msg_obj=None, suffix=""):
+
+        if msg_obj is None:
+            msg_obj = self.kwargs.get('msg_obj')
+        if not msg_obj or not msg_obj.get('message'):
+            return None
+
+        key = ":".join([str(self.kwargs.get('task_id')), str(msg_obj['message']), str(channel_name), suffix])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
     def create_doover_client(self):
-        self.cli = pd.doover_iface(
+        self.cli = pd.get_doover_client(
             agent_id=self.kwargs['agent_id'],
             access_token=self.kwargs['access_token'],
             endpoint=self.kwargs['api_endpoint'],
+            pool_size=self.kwargs.get('package_config', {}).get('pool_size', pd.DEFAULT_POOL_SIZE),
         )
 
-    def add_to_log(self, msg):
+    def create_async_doover_client(self):
+        self.async_cli = pd.get_async_doover_client(
+            agent_id=self.kwargs['agent_id'],
+            access_token=self.kwargs['access_token'],
+            endpoint=self.kwargs['api_endpoint'],
+        )
+        if getattr(self, 'api_timer', None) is not None:
+            self.async_cli.api_client.add_tracer(self.api_timer)
+        self.async_cli.api_client.api_client.set_outbox(self.cli.api_client.outbox)
+
+    ## Spool publishes that fail to a local outbox rather than losing them, and
+    ## send anything spooled by earlier invocations for this agent first
+    ## package_config['outbox_dir'] sets where it is kept, and
+    ## package_config['outbox'] = False turns it off
+    def setup_outbox(self):
+
+        if not self.kwargs['package_config'].get('outbox', True):
+            self.cli.set_outbox(None)
+            return
+
+        try:
+            outbox = pd.get_publish_outbox(self.kwargs['package_config'].get('outbox_dir', DEFAULT_OUTBOX_DIR))
+        except Exception as e:
+            self.add_to_log("Error opening outbox - " + str(e), level="WARNING")
+            self.cli.set_outbox(None)
+            return
+        self.cli.set_outbox(outbox)
+        self.outbox_parked = outbox.count_parked(self.cli.api_client.endpoint, self.kwargs['agent_id'])
+
+        if not outbox.has_pending(self.cli.api_client.endpoint, self.kwargs['agent_id']):
+            return
+        try:
+            flushed = self.cli.flush_outbox(use_batch=self.use_batch_publish())
+            self.add_to_log( "Published " + str(flushed) + " spooled messages from the outbox" )
+        except Exception as e:
+            self.add_to_log("Error flushing outbox - " + str(e), level="WARNING")
+
+    ## Off by default - the batch publish endpoint (POST /ch/v1/publish/) isn't
+    ## available on every Doover server yet
+    def use_batch_publish(self):
+        return self.kwargs['package_config'].get('batch_publish', False)
+
+    ## Warn about anything this invocation had to leave in the outbox
+    def check_outbox(self):
+
+        outbox = self.cli.api_client.outbox
+        if outbox is None:
+            return
+        pending = outbox.count_pending(self.cli.api_client.endpoint, self.kwargs['agent_id'])
+        if pending > 0:
+            self.add_to_log( str(pending) + " messages waiting in the outbox - last error : " + str(outbox.last_error), level="WARNING" )
+        parked = outbox.count_parked(self.cli.api_client.endpoint, self.kwargs['agent_id'])
+        parked_before = getattr(self, 'outbox_parked', 0)
+        if parked > parked_before:
+            self.add_to_log( str(parked - parked_before) + " spooled messages could not be published and were parked in the outbox - last error : " + str(outbox.last_error), level="WARNING" )
+
+    ## Time every API call made during this invocation, so the log shows a
+    ## per call latency breakdown - disable with package_config['log_api_timings'] = False
+    def start_api_timing(self):
+
+        self.api_timer = None
+        if not self.kwargs.get('package_config', {}).get('log_api_timings', True):
+            return
+
+        self.api_timer = pd.timing_tracer()
+        self.cli.api_client.add_tracer(self.api_timer)
+
+    def finish_api_timing(self):
+
+        if getattr(self, 'api_timer', None) is None:
+            return
+
+        self.cli.api_client.remove_tracer(self.api_timer)
+        if hasattr(self, 'async_cli'):
+            self.async_cli.api_client.remove_tracer(self.api_timer)
+
+        self.add_to_log( self.api_timer.format_breakdown() )
+        self.api_timer = None
+
+    def add_to_log(self, msg, level="INFO"):
         if not hasattr(self, '_log'):
-            self._log = ""
-        self._log = self._log + str(msg) + "\n"
+            self._log = pd.log_buffer(
+                max_chars=self.kwargs.get('package_config', {}).get('log_max_chars', pd.DEFAULT_LOG_MAX_CHARS),
+            )
+        self._log.add(msg, level)
+
+    ## A summary of the invocation kwargs for the log - large values (the msg_obj
+    ## payload, package_config, ...) are cut down and the access token is hidden
+    def get_kwargs_summary(self, max_chars=KWARGS_SUMMARY_MAX_CHARS):
+
+        summary = {}
+        for key, value in self.kwargs.items():
+            if key == 'access_token':
+                summary[key] = "<hidden>"
+                continue
+            if key == 'msg_objs' and isinstance(value, list):
+                summary[key] = "<" + str(len(value)) + " messages>"
+                continue
+            if key == 'msg_obj' and isinstance(value, dict):
+                value = {
+                    'message' : value.get('message'),
+                    'channel' : value.get('channel'),
+                    'payload' : value.get('payload'),
+                }
+            value_str = str(value)
+            if len(value_str) > max_chars:
+                value_str = value_str[:max_chars] + "... (" + str(len(value_str)) + " chars)"
+            summary[key] = value_str
+
+        return summary
 
     def complete_log(self):
+        ## No log channel when run in fleet mode without one
+        if not self.kwargs.get('log_channel'):
+            return
         if hasattr(self, '_log') and self._log is not None:
             log_channel = self.cli.get_channel( channel_id=self.kwargs['log_channel'] )
             log_channel.publish(
-                msg_str=self._log
+                msg_str=self._log.serialize(),
+                idempotency_key=self.get_idempotency_key("log")
             )
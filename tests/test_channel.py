@@ -0,0 +1,56 @@
+import os, sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "processor"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import pydoover as pd
+from fake_doover_api import fake_doover_api
+
+
+AGENT_ID = "test-agent"
+
+
+@pytest.fixture
+def api():
+    api = fake_doover_api().start()
+    yield api
+    api.stop()
+    pd._circuit_breakers.clear()
+
+
+def get_channel_by_name(api, name):
+    cli = pd.doover_iface(agent_id=AGENT_ID, access_token="test-token", endpoint=api.endpoint)
+    return cli.get_channel(agent_id=AGENT_ID, channel_name=name)
+
+
+def test_fetch_payloads_of_get_messages_on_channel_opened_by_name(api):
+
+    api.add_messages(AGENT_ID, "uplinks", [{"n" : i} for i in range(5)])
+    c = get_channel_by_name(api, "uplinks")
+
+    messages = c.get_messages()
+    assert all(m.channel_id == api.get_channel(AGENT_ID, "uplinks").channel_id for m in messages)
+    assert c.fetch_payloads(messages) == [{"n" : i} for i in reversed(range(5))]
+
+
+def test_get_payload_on_channel_opened_by_name(api):
+
+    api.add_messages(AGENT_ID, "uplinks", [{"n" : 0}])
+    c = get_channel_by_name(api, "uplinks")
+
+    assert c.get_messages()[0].get_payload() == {"n" : 0}
+
+
+def test_iter_messages_raises_when_endpoint_ignores_cursor(api):
+
+    api.add_messages(AGENT_ID, "uplinks", [{"n" : i} for i in range(5)])
+    c = get_channel_by_name(api, "uplinks")
+
+    get_page = c.api_client.get_channel_messages_page
+    c.api_client.get_channel_messages_page = lambda **kwargs: get_page(**dict(kwargs, before=None))
+
+    with pytest.raises(Exception, match="ignored the before cursor"):
+        list(c.iter_messages(page_size=2))
@@ -0,0 +1,121 @@
+import os, sys, json
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "processor"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import pydoover as pd
+from fake_doover_api import fake_doover_api
+
+
+AGENT_ID = "test-agent"
+
+
+@pytest.fixture
+def api():
+    api = fake_doover_api().start()
+    yield api
+    api.stop()
+    pd._circuit_breakers.clear()
+    pd._batch_publish_unavailable.clear()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = pd.publish_outbox(str(tmp_path), max_attempts=2)
+    yield outbox
+    outbox.close()
+
+
+def make_client(api, outbox):
+    client = pd.doover_api_iface(agent_id=AGENT_ID, access_token="test-token", endpoint=api.endpoint, max_retries=0)
+    client.set_outbox(outbox)
+    return client
+
+
+def get_payloads(api, name):
+    c = api.get_channel(AGENT_ID, name)
+    return [m["payload"] for m in c.messages]
+
+
+def make_item(channel_id=None, channel_name=None, n=0):
+    return {
+        "msg_str" : json.dumps({"n" : n}),
+        "channel_id" : channel_id,
+        "agent_id" : AGENT_ID if channel_name is not None else None,
+        "channel_name" : channel_name,
+        "idempotency_key" : None,
+    }
+
+
+def test_refused_publish_is_raised_not_spooled(api, outbox):
+
+    client = make_client(api, outbox)
+    with pytest.raises(pd.publish_error) as e:
+        client.publish_or_spool(json.dumps({"n" : 0}), channel_id="deleted-channel")
+    assert e.value.status == 404
+    assert not outbox.has_pending(api.endpoint, AGENT_ID)
+
+
+def test_unavailable_publish_is_spooled(api, outbox):
+
+    client = make_client(api, outbox)
+    api.fail_next(1, status=503)
+    assert client.publish_or_spool(json.dumps({"n" : 0}), agent_id=AGENT_ID, channel_name="test") is None
+    assert outbox.count_pending(api.endpoint, AGENT_ID) == 1
+
+    assert client.flush_outbox() == 1
+    assert get_payloads(api, "test") == [{"n" : 0}]
+
+
+def test_flush_parks_refused_message(api, outbox):
+
+    client = make_client(api, outbox)
+    outbox.add(api.endpoint, AGENT_ID, make_item(channel_name="test", n=0))
+    outbox.add(api.endpoint, AGENT_ID, make_item(channel_id="deleted-channel", n=1))
+    outbox.add(api.endpoint, AGENT_ID, make_item(channel_name="test", n=2))
+
+    assert client.flush_outbox() == 2
+    assert get_payloads(api, "test") == [{"n" : 0}, {"n" : 2}]
+    assert outbox.count_pending(api.endpoint, AGENT_ID) == 0
+    assert outbox.count_parked(api.endpoint, AGENT_ID) == 1
+
+    ## Later publishes aren't held up behind it
+    assert client.publish_or_spool(json.dumps({"n" : 3}), agent_id=AGENT_ID, channel_name="test") is not None
+
+
+def test_flush_parks_message_after_max_attempts(api, outbox):
+
+    client = make_client(api, outbox)
+    outbox.add(api.endpoint, AGENT_ID, make_item(channel_name="test", n=0))
+
+    for attempt in range(outbox.max_attempts):
+        api.fail_next(1, status=500)
+        with pytest.raises(pd.publish_error):
+            client.flush_outbox()
+
+    assert outbox.count_pending(api.endpoint, AGENT_ID) == 0
+    assert outbox.count_parked(api.endpoint, AGENT_ID) == 1
+
+
+def test_outbox_without_parking_columns_is_migrated(tmp_path):
+
+    import sqlite3
+    db = sqlite3.connect(os.path.join(str(tmp_path), pd.OUTBOX_FILE_NAME))
+    db.execute(
+        "CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, endpoint TEXT NOT NULL, owner TEXT NOT NULL, "
+        "channel_id TEXT, agent_id TEXT, channel_name TEXT, msg_str TEXT NOT NULL, idempotency_key TEXT, created REAL NOT NULL)"
+    )
+    db.execute(
+        "INSERT INTO outbox (endpoint, owner, channel_name, agent_id, msg_str, created) VALUES ('e', ?, 'test', ?, '{}', 0)",
+        (AGENT_ID, AGENT_ID),
+    )
+    db.commit()
+    db.close()
+
+    outbox = pd.publish_outbox(str(tmp_path))
+    assert outbox.count_pending("e", AGENT_ID) == 1
+    assert outbox.count_parked("e", AGENT_ID) == 0
+    outbox.close()
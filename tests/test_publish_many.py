@@ -0,0 +1,54 @@
+import os, sys, json
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "processor"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import pydoover as pd
+from fake_doover_api import fake_doover_api
+
+
+AGENT_ID = "test-agent"
+
+
+@pytest.fixture
+def api():
+    api = fake_doover_api().start()
+    yield api
+    api.stop()
+    pd._circuit_breakers.clear()
+    pd._batch_publish_unavailable.clear()
+
+
+def make_publishes(api):
+    cli = pd.doover_iface(agent_id=AGENT_ID, access_token="test-token", endpoint=api.endpoint)
+    cli.api_client.max_retries = 0
+    return cli, [
+        (cli.get_channel(agent_id=AGENT_ID, channel_name=name), json.dumps({"n" : i}), "key-" + name)
+        for i, name in enumerate(["ui_state", "location"])
+    ]
+
+
+def get_payloads(api, name):
+    return [m["payload"] for m in api.get_channel(AGENT_ID, name).messages]
+
+
+def test_refused_batch_falls_back_to_per_channel_publishes(api):
+
+    cli, publishes = make_publishes(api)
+    api.fail_next(1, status=400)
+    results = cli.publish_many(publishes, use_batch=True)
+
+    assert None not in results
+    assert get_payloads(api, "ui_state") == [{"n" : 0}]
+    assert get_payloads(api, "location") == [{"n" : 1}]
+
+
+def test_unavailable_batch_is_raised_without_outbox(api):
+
+    cli, publishes = make_publishes(api)
+    api.fail_next(1, status=503)
+    with pytest.raises(pd.publish_error):
+        cli.publish_many(publishes, use_batch=True)
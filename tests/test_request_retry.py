@@ -0,0 +1,161 @@
+import os, sys, json, time
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "processor"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import pydoover as pd
+from fake_doover_api import fake_doover_api
+
+
+AGENT_ID = "test-agent"
+
+RESET_TIMEOUT = 0.2
+
+
+@pytest.fixture
+def api():
+    api = fake_doover_api().start()
+    yield api
+    api.stop()
+    pd._circuit_breakers.clear()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(pd.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def make_client(api, max_retries=0):
+    return pd.doover_api_iface(agent_id=AGENT_ID, access_token="test-token", endpoint=api.endpoint, max_retries=max_retries)
+
+
+def make_breaker(api, threshold=3):
+    breaker = pd.circuit_breaker(threshold=threshold, reset_timeout=RESET_TIMEOUT)
+    pd._circuit_breakers[api.endpoint] = breaker
+    return breaker
+
+
+def get_agent(client):
+    return client.request_with_retry("GET", "/ch/v1/agent/" + AGENT_ID + "/")
+
+
+def get_payloads(api, name):
+    c = api.get_channel(AGENT_ID, name)
+    return [m["payload"] for m in c.messages]
+
+
+def test_circuit_opens_after_threshold_failures(api):
+
+    make_breaker(api, threshold=3)
+    client = make_client(api)
+
+    api.fail_next(3, status=503)
+    for i in range(3):
+        assert get_agent(client).status_code == 503
+
+    api.reset_stats()
+    with pytest.raises(pd.circuit_open_error):
+        get_agent(client)
+    assert api.get_stats()["requests"] == 0
+
+
+def test_half_open_circuit_lets_one_trial_through(api):
+
+    breaker = make_breaker(api, threshold=1)
+    client = make_client(api)
+
+    api.fail_next(1, status=503)
+    get_agent(client)
+    time.sleep(RESET_TIMEOUT)
+
+    ## The first caller is the trial - the rest fail fast until it reports back
+    breaker.check()
+    with pytest.raises(pd.circuit_open_error):
+        breaker.check()
+
+    breaker.record_success()
+    assert get_agent(client).status_code == 200
+
+
+def test_failed_trial_reopens_circuit(api):
+
+    make_breaker(api, threshold=3)
+    client = make_client(api)
+
+    api.fail_next(3, status=503)
+    for i in range(3):
+        get_agent(client)
+    time.sleep(RESET_TIMEOUT)
+
+    api.fail_next(1, status=503)
+    assert get_agent(client).status_code == 503
+
+    api.reset_stats()
+    with pytest.raises(pd.circuit_open_error):
+        get_agent(client)
+    assert api.get_stats()["requests"] == 0
+
+    time.sleep(RESET_TIMEOUT)
+    assert get_agent(client).status_code == 200
+    assert get_agent(client).status_code == 200
+
+
+def test_get_is_retried_with_backoff(api, sleeps):
+
+    client = make_client(api, max_retries=3)
+
+    api.fail_next(2, status=503)
+    assert get_agent(client).status_code == 200
+    assert api.get_stats()["requests"] == 3
+
+    ## Full jitter - each wait is somewhere up to the doubling backoff
+    assert len(sleeps) == 2
+    for attempt, delay in enumerate(sleeps, start=1):
+        assert 0 <= delay <= client.backoff_base * (2 ** (attempt - 1))
+
+
+def test_get_gives_up_after_max_retries(api, sleeps):
+
+    client = make_client(api, max_retries=2)
+
+    api.fail_next(3, status=500)
+    assert get_agent(client).status_code == 500
+    assert api.get_stats()["requests"] == 3
+    assert len(sleeps) == 2
+
+
+def test_backoff_is_capped(api):
+
+    client = pd.doover_api_iface(agent_id=AGENT_ID, access_token="test-token", endpoint=api.endpoint, backoff_base=1.0, backoff_max=2.0)
+    assert all(0 <= client.get_backoff(10) <= 2.0 for i in range(100))
+
+
+def test_post_without_idempotency_key_is_not_retried(api, sleeps):
+
+    client = make_client(api, max_retries=3)
+
+    api.fail_next(1, status=503)
+    with pytest.raises(pd.publish_error) as e:
+        client.publish_to_channel(json.dumps({"n" : 0}), agent_id=AGENT_ID, channel_name="test")
+    assert e.value.status == 503
+    assert api.get_stats()["requests"] == 1
+    assert sleeps == []
+    assert get_payloads(api, "test") == []
+
+
+def test_post_with_idempotency_key_is_retried_and_published_once(api, sleeps):
+
+    client = make_client(api, max_retries=3)
+
+    api.fail_next(1, status=503)
+    client.publish_to_channel(json.dumps({"n" : 0}), agent_id=AGENT_ID, channel_name="test", idempotency_key="key-0")
+    assert api.get_stats()["requests"] == 2
+
+    ## A retry of a publish that did reach the API isn't published again
+    client.publish_to_channel(json.dumps({"n" : 0}), agent_id=AGENT_ID, channel_name="test", idempotency_key="key-0")
+    assert get_payloads(api, "test") == [{"n" : 0}]